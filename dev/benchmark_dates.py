@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+"""
+Simple script to check hsdate.get_isot_mjd() against astropy.time for random
+unix timestamps from 1972 onwards, the days around every leap second and
+timestamps on half-millisecond rounding edges, and to time both.
+"""
+
+import time
+import random
+import argparse
+from astropy.time import Time
+from HeaderService import hsdate
+
+
+def build_timestamps(nrandom, seed):
+    "Random timestamps plus the edges around leap seconds and milliseconds"
+    rng = random.Random(seed)
+    ts = [rng.uniform(hsdate.UNIX_LEAP_START, 4102444800.0) for k in range(nrandom)]
+    for (year, month, _) in hsdate.LEAP_SECONDS[1:]:
+        t0 = Time(f"{year}-{month:02d}-01T00:00:00", scale='utc').unix
+        for dt in range(-86400, 2000, 37):
+            ts.append(t0 + dt + rng.choice([0.0, 0.0005, 0.9995, 0.4999999]))
+    for k in range(nrandom):
+        sec = rng.randrange(int(hsdate.UNIX_LEAP_START), 4102444800)
+        ts.append(sec + rng.randrange(1000)/1000 + 0.0005)
+    return ts
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check and benchmark hsdate")
+    parser.add_argument("--nrandom", type=int, default=20000,
+                        help="Number of random timestamps")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Seed for the random timestamps")
+    args = parser.parse_args()
+
+    ts = build_timestamps(args.nrandom, args.seed)
+
+    t0 = time.perf_counter()
+    ref = []
+    for t in ts:
+        date = Time(t, format='unix', scale='utc')
+        ref.append((date.isot, float(date.mjd)))
+    t_old = (time.perf_counter() - t0)/len(ts)
+
+    t0 = time.perf_counter()
+    new = [hsdate.get_isot_mjd(t) for t in ts]
+    t_new = (time.perf_counter() - t0)/len(ts)
+
+    bad = [(t, a, b) for t, a, b in zip(ts, new, ref) if a != b]
+    for t, a, b in bad[:10]:
+        print(f"Mismatch for {t!r}: hsdate: {a} astropy: {b}")
+    print(f"Checked {len(ts)} timestamps, mismatches: {len(bad)}")
+    print(f"astropy: {1e6*t_old:8.2f}[us] hsdate: {1e6*t_new:8.2f}[us] x{t_old/t_new:5.1f}")
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+"""
+Simple benchmark script to compare the one-pass template parser
+read_head_template() against the fitsio-based read_head_template_fitsio()
+for all of the templates in etc/*/*.header. It also checks that both
+parsers return the same records and keyword index.
+"""
+
+import glob
+import os
+import time
+import argparse
+from HeaderService import hutils
+
+
+def records_equal(hdr1, hdr2):
+    "Compare the records and index maps of two FITSHDR"
+    recs1 = [dict(rec) for rec in hdr1._record_list]
+    recs2 = [dict(rec) for rec in hdr2._record_list]
+    return recs1 == recs2 and hdr1._index_map == hdr2._index_map
+
+
+def time_parser(parser, fname, loops):
+    t0 = time.perf_counter()
+    for k in range(loops):
+        parser(fname)
+    return (time.perf_counter() - t0)/loops
+
+
+if __name__ == "__main__":
+
+    etc = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'etc')
+    parser = argparse.ArgumentParser(description="Benchmark template parsers")
+    parser.add_argument("--loops", type=int, default=20,
+                        help="Number of reads per template")
+    parser.add_argument("templates", nargs='*',
+                        default=sorted(glob.glob(os.path.join(etc, '*', '*.header'))),
+                        help="Template files to read")
+    args = parser.parse_args()
+
+    total_new = 0
+    total_old = 0
+    for fname in args.templates:
+        same = records_equal(hutils.read_head_template(fname),
+                             hutils.read_head_template_fitsio(fname))
+        t_new = time_parser(hutils.read_head_template, fname, args.loops)
+        t_old = time_parser(hutils.read_head_template_fitsio, fname, args.loops)
+        total_new += t_new
+        total_old += t_old
+        print(f"{os.path.basename(fname):35s} fitsio: {1e3*t_old:8.3f}[ms] "
+              f"native: {1e3*t_new:8.3f}[ms] x{t_old/t_new:5.1f} same: {same}")
+    print(f"{'Total':35s} fitsio: {1e3*total_old:8.3f}[ms] "
+          f"native: {1e3*total_new:8.3f}[ms] x{total_old/total_new:5.1f}")
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Simple script to check that the vectorized camera_coords.get_mosaic_arrays()
+returns the same IRAF/Mosaic keywords as the per-segment
+CCDInfo.setup_segment_geom() for ITL, E2V and mixed focal planes, with the
+vendor defaults and random readout geometries. The DUMMY vendor is checked
+against E2V, as SCAN_GEOM['DUMMY'] is a copy of it. Exits with status 1 if
+there are mismatches.
+"""
+
+import sys
+import random
+import argparse
+from HeaderService import camera_coords
+
+
+def random_geom(rng, vendor):
+    "Random readout geometry around the vendor defaults"
+    defaults = camera_coords.SCAN_GEOM[vendor]
+    return {'dimh': defaults['dimh'] + rng.randrange(-8, 9),
+            'dimv': defaults['dimv'] + rng.randrange(-8, 9),
+            'preh': rng.randrange(0, 16),
+            'overh': defaults['overh'],
+            'overv': defaults['overv']}
+
+
+def reference_geometry(vendor, geom, segments):
+    "The keywords per segment from CCDInfo.setup_segment_geom()"
+    ccd = camera_coords.CCDInfo('E2V' if vendor == 'DUMMY' else vendor)
+    ccd.update_geom_params(geom)
+    primary = ccd.setup_primary_geom()
+    return primary, [ccd.setup_segment_geom(seg) for seg in segments]
+
+
+def check_focal_plane(vendors, geoms, segments):
+    "Compare both implementations for a focal plane, return the mismatches"
+    mosaic = camera_coords.get_mosaic_arrays(vendors,
+                                             [geom['dimh'] for geom in geoms],
+                                             [geom['dimv'] for geom in geoms],
+                                             [geom['preh'] for geom in geoms],
+                                             segments=segments)
+    bad = []
+    for i, (vendor, geom) in enumerate(zip(vendors, geoms)):
+        primary, ref = reference_geometry(vendor, geom, segments)
+        checks = [('DETSIZE', primary['DETSIZE'], mosaic['DETSIZE'][i].item())]
+        for j, seg in enumerate(segments):
+            checks.append(('DATASEC', ref[j]['DATASEC'], mosaic['DATASEC'][i].item()))
+            for key in camera_coords.MOSAIC_KEYS:
+                checks.append((key, ref[j][key], mosaic[key][i, j].item()))
+        for key, a, b in checks:
+            # The type matters too, as it changes the rendered card
+            if a != b or type(a) is not type(b):
+                bad.append((vendor, geom, key, a, b))
+    return bad
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check the vectorized focal-plane geometry")
+    parser.add_argument("--nsensors", type=int, default=189,
+                        help="Number of sensors per focal plane")
+    parser.add_argument("--ntrials", type=int, default=20,
+                        help="Number of focal planes with random geometries")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Seed for the random geometries")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    segments = [camera_coords.SLAC_SEGNAME[hdu] for hdu in camera_coords.SLAC_SEGNAME]
+    focal_planes = {'ITL': ['ITL']*args.nsensors,
+                    'E2V': ['E2V']*args.nsensors,
+                    'DUMMY': ['DUMMY']*args.nsensors,
+                    'mixed': [rng.choice(['ITL', 'E2V', 'DUMMY']) for k in range(args.nsensors)]}
+
+    nbad = 0
+    for name, vendors in focal_planes.items():
+        # The vendor defaults first, then random geometries per sensor
+        trials = [[camera_coords.SCAN_GEOM[vendor] for vendor in vendors]]
+        trials += [[random_geom(rng, vendor) for vendor in vendors] for k in range(args.ntrials)]
+        bad = []
+        for geoms in trials:
+            bad.extend(check_focal_plane(vendors, geoms, segments))
+        for vendor, geom, key, a, b in bad[:10]:
+            print(f"Mismatch for {vendor} {geom} {key}: CCDInfo: {a!r} get_mosaic_arrays: {b!r}")
+        print(f"Checked {name:5s} focal plane x {len(trials)} geometries, mismatches: {len(bad)}")
+        nbad += len(bad)
+
+    sys.exit(1 if nbad > 0 else 0)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""
+Simple script to check the event loop blocking time recorded per image by
+HSWorker.record_loop_time(). A HSWorker is made without starting the CSC,
+and a blocking function is run with run_blocking() with no executor (it is
+timed) and with a thread executor (it is not). Exits with status 1 if the
+checks fail.
+"""
+
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import concurrent.futures
+from HeaderService import hslib_salobj
+
+
+def make_worker(executor):
+    "A HSWorker with only the attributes used to time the images"
+    hs = hslib_salobj.HSWorker.__new__(hslib_salobj.HSWorker)
+    hs.log = logging.getLogger(__name__)
+    hs.executor = executor
+    hs.loop_time = {}
+    hs.image_loop_times = {}
+    return hs
+
+
+async def run_image(hs, imageName, sleep):
+    "Run a blocking function and a timed section for imageName"
+    await hs.run_blocking(imageName, time.sleep, sleep)
+    t0 = time.time()
+    time.sleep(sleep)
+    hs.add_loop_time(imageName, t0)
+    hs.record_loop_time(imageName)
+    hs.loop_time.pop(imageName)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check the event loop blocking time per image")
+    parser.add_argument("--sleep", type=float, default=0.05,
+                        help="The time in seconds of each blocking call")
+    args = parser.parse_args()
+
+    errors = []
+    hs = make_worker(None)
+    asyncio.run(run_image(hs, 'inline', args.sleep))
+    if not 2*args.sleep <= hs.image_loop_times['inline'] < 3*args.sleep:
+        errors.append(f"executor: none, loop time: {hs.image_loop_times['inline']:.3f} [s]")
+
+    hs = make_worker(concurrent.futures.ThreadPoolExecutor(max_workers=1))
+    asyncio.run(run_image(hs, 'thread', args.sleep))
+    if not args.sleep <= hs.image_loop_times['thread'] < 2*args.sleep:
+        errors.append(f"executor: thread, loop time: {hs.image_loop_times['thread']:.3f} [s]")
+    hs.executor.shutdown()
+
+    # Only the last images are kept
+    hs = make_worker(None)
+    for k in range(hslib_salobj.MAX_IMAGE_LOOP_TIMES + 10):
+        hs.record_loop_time(f"image_{k}")
+    if len(hs.image_loop_times) != hslib_salobj.MAX_IMAGE_LOOP_TIMES or 'image_0' in hs.image_loop_times:
+        errors.append(f"image_loop_times keeps {len(hs.image_loop_times)} images")
+
+    for msg in errors:
+        print(f"Failed: {msg}")
+    print(f"Checked the event loop blocking time per image, errors: {len(errors)}")
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+"""
+Simple script to check the reduction of the monitored keywords in
+monitor_mode: 'buffer'. A HSWorker is made without starting the CSC, with
+the samples of an int-valued, a float-valued and a mixed channel fed
+through record_monitor_samples(). The min/max of int-valued channels must
+stay Python ints, so the header cards keep their type. Exits with status 1
+if the checks fail.
+"""
+
+import sys
+import time
+import types
+import logging
+from HeaderService import hslib_salobj
+
+# keyword: (rule, samples, value at START, expected value and type)
+CASES = {'INTMAX': ('max', [3, 7, 5], 4, 7),
+         'INTMIN': ('min', [3, 7, 5], 4, 3),
+         'INTLAST': ('latest', [3, 7, 5], 4, 5),
+         'FLTMAX': ('max', [3.5, 7.5, 5.0], None, 7.5),
+         'FLTMEAN': ('mean', [1.0, 2.0, 3.0], 2.0, 2.0),
+         'MIXMAX': ('max', [3, 7.5, 5], 4, 7.5),
+         'INTMEAN': ('mean', [3, 7, 5], 5, 5.0)}
+
+
+def make_worker():
+    "A HSWorker with only the attributes used by the monitor buffers"
+    hs = hslib_salobj.HSWorker.__new__(hslib_salobj.HSWorker)
+    hs.log = logging.getLogger(__name__)
+    hs.config = types.SimpleNamespace(monitor_buffer_size=16,
+                                      telemetry={key: {'rule': rule} for key, (rule, *_) in CASES.items()})
+    hs.monitor_event_channels_keys = {'channel': list(CASES)}
+    hs.enum_keywords = set()
+    hs.create_monitor_buffers()
+    return hs
+
+
+if __name__ == "__main__":
+
+    hs = make_worker()
+    imageName = 'image'
+    hs.start_time = {imageName: time.time()}
+    hs.metadata = {imageName: {key: start for key, (_, _, start, _) in CASES.items() if start is not None}}
+    for k in range(3):
+        samples = {key: values[k] for key, (_, values, _, _) in CASES.items()}
+        hs.collect = lambda keys: samples
+        hs.record_monitor_samples(list(CASES))
+    hs.reduce_monitor_metadata(imageName)
+
+    errors = []
+    for key, (rule, _, _, expected) in CASES.items():
+        value = hs.metadata[imageName].get(key)
+        if value != expected or type(value) is not type(expected):
+            errors.append(f"{key} ({rule}): {value!r}, expected: {expected!r}")
+    for msg in errors:
+        print(f"Failed: {msg}")
+    print(f"Checked {len(CASES)} monitored keywords in monitor_mode: buffer, errors: {len(errors)}")
+    sys.exit(1 if errors else 0)
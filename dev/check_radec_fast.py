@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+"""
+Simple script to check the fast mode of hscalc.get_radec_from_altaz()
+against astropy for an array Time, with the array of dut1 from
+Time.delta_ut1_utc. The separation must be below --tolerance arcsec, and
+the array call must match the calls for one obstime at a time. Exits with
+status 1 if the checks fail.
+"""
+
+import sys
+import argparse
+import numpy
+from astropy.time import Time, TimeDelta
+from astropy.coordinates import SkyCoord
+from HeaderService import hscalc
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check the fast alt/az to ra/dec transform")
+    parser.add_argument("--ntimes", type=int, default=200,
+                        help="Number of obstimes")
+    parser.add_argument("--start", default="2021-06-01T00:00:00",
+                        help="The first obstime (UTC), within the IERS tables")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="The maximum separation in arcsec")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Seed for the random alt/az and times")
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(args.seed)
+    alt = rng.uniform(20, 89, args.ntimes)
+    az = rng.uniform(0, 360, args.ntimes)
+    seconds = numpy.sort(rng.uniform(0, 10*86400, args.ntimes))
+    obstime = Time(args.start, scale='utc') + TimeDelta(seconds, format='sec')
+    dut1 = obstime.delta_ut1_utc
+
+    ra, dec = hscalc.get_radec_from_altaz(alt, az, obstime, fast=True, dut1=dut1)
+    ra_ref, dec_ref = hscalc.get_radec_from_altaz(alt, az, obstime)
+    sep = SkyCoord(ra, dec, unit='deg').separation(SkyCoord(ra_ref, dec_ref, unit='deg')).arcsec
+    print(f"Checked {args.ntimes} obstimes with array dut1, max separation: {sep.max():.3f} [arcsec]")
+
+    single = numpy.array([hscalc.get_radec_from_altaz(alt[k], az[k], obstime[k], fast=True, dut1=dut1[k])
+                          for k in range(args.ntimes)])
+    diff = numpy.abs(single - numpy.array([ra, dec]).T).max()
+    print(f"Max difference with one obstime at a time: {diff:.2e} [deg]")
+
+    sys.exit(1 if sep.max() > args.tolerance or diff > 1e-9 else 0)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+Simple script to check the streaming YAML emitter hutils.emit_header_yaml()
+for all of the templates in etc/*/*.header. Each template is written as is,
+and with random values (strings that need quoting, ints, floats, bools and
+None) for its keywords. Long strings that PyYAML folds are left out, as the
+emitter falls back to PyYAML for them. The text must be the same as
+yaml.dump() and read back with yaml.safe_load() to the same records. Exits
+with status 1 if there are mismatches.
+"""
+
+import sys
+import glob
+import os
+import random
+import argparse
+import yaml
+from HeaderService import hutils
+
+STRINGS = ['', 'x', 'yes', 'No', 'null', '~', '1.5', '007', '-', 'a: b', '#comment',
+           "it's", ' lead', 'trail ', '2020-05-21T00:00:00.000', '[1:509,1:2000]',
+           'R22_S11']
+NUMBERS = [0, 1, -1, 12345678901234, 0.0, -0.5, 1.5e-10, 3.14159265358979, 1e20, float('inf'),
+           True, False, None]
+
+
+def random_value(rng):
+    "A random value for a record"
+    return rng.choice(STRINGS) if rng.random() < 0.5 else rng.choice(NUMBERS)
+
+
+def reference_records(overlay):
+    "The records of the overlay as written by the PyYAML path"
+    return [{'keyword': rec['name'], 'value': rec['value'], 'comment': rec.get('comment', '')}
+            for rec in overlay.records()]
+
+
+def check_overlay(extname, overlay):
+    "Compare the emitter with yaml.dump(), return (fallback, mismatches)"
+    text = hutils.emit_header_yaml([(extname, overlay)])
+    if text is None:
+        return 1, []
+    bad = []
+    header = {extname: reference_records(overlay)}
+    ref = yaml.dump(header, default_flow_style=False, sort_keys=False)
+    if text != ref:
+        bad.append(('yaml.dump', text, ref))
+    loaded = yaml.safe_load(text)
+    if loaded != header:
+        bad.append(('yaml.safe_load', loaded, header))
+    return 0, bad
+
+
+if __name__ == "__main__":
+
+    etc = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'etc')
+    parser = argparse.ArgumentParser(description="Check the streaming YAML emitter")
+    parser.add_argument("--ntrials", type=int, default=20,
+                        help="Number of headers with random values per template")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Seed for the random values")
+    parser.add_argument("templates", nargs='*',
+                        default=sorted(glob.glob(os.path.join(etc, '*', '*.header'))),
+                        help="Template files to write")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    nbad = 0
+    for fname in args.templates:
+        template = hutils.read_head_template(fname)
+        extname = os.path.splitext(os.path.basename(fname))[0]
+        nfallback, bad = check_overlay(extname, hutils.HDROverlay(template))
+        for k in range(args.ntrials):
+            overlay = hutils.HDROverlay(template)
+            for keyword in overlay.keys():
+                if keyword and rng.random() < 0.5:
+                    overlay.update_record(keyword, random_value(rng))
+            fallback, mismatches = check_overlay(extname, overlay)
+            nfallback += fallback
+            bad.extend(mismatches)
+        for check, a, b in bad[:3]:
+            print(f"Mismatch in {check} for {fname}:\n{a}\n{b}")
+        print(f"Checked {fname} x {args.ntrials + 1}, PyYAML fallbacks: {nfallback}, "
+              f"mismatches: {len(bad)}")
+        nbad += len(bad)
+
+    sys.exit(1 if nbad > 0 else 0)
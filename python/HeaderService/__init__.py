@@ -24,6 +24,18 @@ __version__ = "3.5.8"
 version = __version__
 
 from . import hutils
-from . import hslib_salobj
 from . import camera_coords
 from . import hsregex
+from . import hsdate
+from . import hsconfig
+
+# Modules with heavy dependencies (lsst.ts.salobj, astropy) are imported
+# on first access, i.e. HeaderService.hslib_salobj
+LAZY_MODULES = ('hslib_salobj', 'hscalc')
+
+
+def __getattr__(name):
+    if name in LAZY_MODULES:
+        import importlib
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -21,6 +21,7 @@
 
 import HeaderService
 import logging
+import numpy
 LOGGER = logging.getLogger(__name__)
 
 """This module describe the CCD/Camera coordinate systems as described in
@@ -146,6 +147,9 @@ SEGNAME['ComCam'] = SLAC_SEGNAME
 SEGNAME['LSSTCam'] = SLAC_SEGNAME
 SEGNAME['GenericCamera'] = {1: '1'}
 
+# The per-segment IRAF/Mosaic keywords from get_mosaic_arrays()
+MOSAIC_KEYS = ('DTM1_1', 'DTM1_2', 'DTM2_1', 'DTM2_2', 'DTV1', 'DTV2', 'DETSEC')
+
 
 """
 Useful to mock up the message with the sensor list
@@ -329,3 +333,95 @@ class CCDInfo:
         EXTENSION_DATA['DTV2'] = (2*self.dimv + 1)*(1 - Sx)
         EXTENSION_DATA['DETSEC'] = "[{:d}:{:d},{:d}:{:d}]".format(dsx1, dsx2, dsy1, dsy2)
         return EXTENSION_DATA
+
+
+def get_mosaic_arrays(vendors, dimh, dimv, preh, segments=SLAC_SEGNAME):
+    """
+    Vectorized version of CCDInfo.mosaic_E2V() and CCDInfo.mosaic_ITL() that
+    computes the IRAF/Mosaic keywords for every sensor x segment of a
+    camera in one batched call using numpy. The DUMMY vendor follows the E2V
+    layout, as SCAN_GEOM['DUMMY'] is a copy of E2V.
+
+    Parameters
+    ----------
+
+    vendors: list
+        The vendor names (i.e.: ITL, E2V or DUMMY), one per sensor
+    dimh, dimv, preh: int or list
+        The segment pixels and pre-scan pixels, one per sensor or a single
+        value for all of the sensors
+    segments: dict or list
+        Optional, the segment names (i.e.: '10') in the order of the output
+        columns, a dictionary is read in the order of its keys (i.e.: HDU
+        number as in SLAC_SEGNAME)
+
+    Returns
+    -------
+
+    mosaic: dict
+       The columnar arrays keyed to keyword name. DETSEC, DTV1, DTV2, DTM1_1,
+       DTM1_2, DTM2_1 and DTM2_2 have shape (nsensors, nsegments), DETSIZE
+       and DATASEC have shape (nsensors,)
+    """
+
+    vendors = numpy.asarray(vendors)
+    unknown = numpy.setdiff1d(vendors, list(SCAN_GEOM.keys()))
+    if len(unknown) > 0:
+        raise ValueError('Vendor: {} not in list '.format(unknown[0]))
+    if isinstance(segments, dict):
+        segments = [segments[hdu] for hdu in segments]
+
+    # Sensors run along axis 0 and segments along axis 1
+    nsensors = len(vendors)
+    dimh = numpy.broadcast_to(numpy.asarray(dimh, dtype=numpy.int64), (nsensors,))[:, None]
+    dimv = numpy.broadcast_to(numpy.asarray(dimv, dtype=numpy.int64), (nsensors,))[:, None]
+    preh = numpy.broadcast_to(numpy.asarray(preh, dtype=numpy.int64), (nsensors,))[:, None]
+    Sx = numpy.array([int(seg[0]) for seg in segments], dtype=numpy.int64)[None, :]
+    Sy = numpy.array([int(seg[1]) for seg in segments], dtype=numpy.int64)[None, :]
+    is_itl = (vendors == 'ITL')[:, None]
+    shape = (nsensors, len(segments))
+
+    mosaic = {}
+    mosaic['DTM1_1'] = numpy.where(is_itl, -1.0, 1. - 2.0*Sx)
+    mosaic['DTM1_2'] = numpy.zeros(shape, dtype=numpy.int64)
+    mosaic['DTM2_1'] = numpy.zeros(shape, dtype=numpy.int64)
+    mosaic['DTM2_2'] = numpy.broadcast_to(2.0*Sx - 1., shape)
+    mosaic['DTV1'] = numpy.where(is_itl,
+                                 dimh + 1 + Sy*dimh + preh,
+                                 (dimh + 1 + 2*preh)*Sx + Sy*dimh - preh)
+    mosaic['DTV2'] = (2*dimv + 1)*(1 - Sx)
+
+    # Formatting the section strings is the expensive part, so we only do it
+    # once for each unique sensor geometry and expand them afterwards
+    params = numpy.hstack([is_itl, dimh, dimv, preh])
+    params, inverse = numpy.unique(params, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    is_itl, dimh, dimv, preh = (params[:, k:k+1] for k in range(4))
+    is_itl = is_itl.astype(bool)
+
+    dsx1 = numpy.where(is_itl,
+                       (Sy + 1)*dimh,
+                       (Sy*dimh + 1)*(1 - Sx) + (Sy + 1)*dimh*Sx)
+    dsx2 = numpy.where(is_itl,
+                       Sy*dimh + 1,
+                       (Sy + 1)*dimh*(1 - Sx) + (Sy*dimh + 1)*Sx)
+    dsy1 = 2*dimv*(1 - Sx) + Sx
+    dsy2 = (dimv + 1)*(1 - Sx) + dimv*Sx
+    mosaic['DETSEC'] = format_section(dsx1, dsx2, dsy1, dsy2)[inverse]
+
+    # The per-sensor keywords
+    mosaic['DETSIZE'] = format_section(1, 8*dimh[:, 0], 1, 2*dimv[:, 0])[inverse]
+    mosaic['DATASEC'] = format_section(preh[:, 0] + 1, preh[:, 0] + dimh[:, 0], 1, dimv[:, 0])[inverse]
+    return mosaic
+
+
+def format_section(x1, x2, y1, y2):
+    """
+    Format arrays of pixel ranges into an array of '[x1:x2,y1:y2]'
+    section strings
+    """
+    x1, x2, y1, y2 = numpy.broadcast_arrays(x1, x2, y1, y2)
+    section = numpy.char.add('[', x1.astype(str))
+    for sep, value in ((':', x2), (',', y1), (':', y2)):
+        section = numpy.char.add(numpy.char.add(section, sep), value.astype(str))
+    return numpy.char.add(section, ']')
@@ -23,15 +23,32 @@
 This module contains the function used by the HeaderService to computed the
 metadata not provided as SAL/DDS Telemetry/Event
 
+astropy is only imported when these functions are called, the header dates
+are computed by hsdate.
+
 """
 
-from astropy.time import Time
-import astropy.units as u
-from astropy.coordinates import AltAz, ICRS, EarthLocation
 import logging
+import functools
+import numpy
+from . import hsdate
 
 LOGGER = logging.getLogger(__name__)
 
+# Default site location (Rubin Observatory)
+SITE_LAT = -30.244639
+SITE_LON = -70.749417
+SITE_HEIGHT = 2663.0
+
+# Time resolution in seconds of the time-dependent astrometry (precession,
+# nutation, aberration) that is shared by the coordinates transformed
+# in a batch, see get_radec_from_altaz_batch()
+TIME_RESOLUTION = 300.0
+
+# Process-wide cache of the ERFA astrometry parameters used by the fast
+# mode, keyed by the time bucket, site and UT1-UTC
+ASTROM_CACHE = {}
+
 
 def get_date(timeStamp=None, format='unix', scale='utc'):
 
@@ -60,6 +77,7 @@ def get_date(timeStamp=None, format='unix', scale='utc'):
 
     """
 
+    from astropy.time import Time
     if timeStamp is None:
         t = Time.now()
     else:
@@ -67,46 +85,253 @@ def get_date(timeStamp=None, format='unix', scale='utc'):
     return t
 
 
-def get_radec_from_altaz(alt, az, obstime, lat=-30.244639, lon=-70.749417, height=2663.0):
+@functools.lru_cache(maxsize=8)
+def get_location(lat=SITE_LAT, lon=SITE_LON, height=SITE_HEIGHT):
+    """
+    Get the (cached) astropy EarthLocation of the site at geographic
+    latitude and longitude in degrees and height in meters
+    """
+    import astropy.units as u
+    from astropy.coordinates import EarthLocation
+    return EarthLocation.from_geodetic(lon*u.deg, lat*u.deg, height*u.m)
+
 
+def get_unix_time(obstime):
     """
-    Get the ra, dec fron the altitude/azimuth and the telescope location
-    using the  astropy AltAz function
+    Get obstime that is not an astropy Time as an array of unix timestamps
+    in seconds (UTC). Anything else (i.e. strings or datetime) is not
+    guessed, and raises TypeError
+    """
+    unix_time = numpy.asarray(obstime)
+    if unix_time.dtype.kind not in 'iuf':
+        raise TypeError(f"obstime must be an astropy Time or unix timestamps (UTC), got: {obstime!r}")
+    return unix_time.astype(float)
+
+
+def get_obstime(obstime):
+    "Get an astropy Time for obstime, as a Time or unix timestamps (UTC)"
+    from astropy.time import Time
+    if isinstance(obstime, Time):
+        return obstime
+    return Time(get_unix_time(obstime), format='unix', scale='utc')
+
+
+def get_obstime_shape(obstime):
+    "Get the shape of obstime, as a Time or unix timestamps (UTC)"
+    if hasattr(obstime, 'utc'):
+        return obstime.shape
+    return get_unix_time(obstime).shape
+
+
+def get_utc_jd(obstime):
+    """
+    Get the two-part UTC Julian Date arrays for obstime, as an astropy
+    Time or unix timestamps (UTC), the latter without importing astropy
+    """
+    if hasattr(obstime, 'utc'):
+        return numpy.atleast_1d(obstime.utc.jd1), numpy.atleast_1d(obstime.utc.jd2)
+    jd = numpy.array([hsdate.unix_to_jd(t) for t in numpy.atleast_1d(get_unix_time(obstime))])
+    return jd[:, 0], jd[:, 1]
+
+
+def get_astrom(bucket, time_resolution, lat, lon, height, dut1):
+    """
+    Get the ERFA astrometry parameters for the middle of a time bucket
+    of time_resolution seconds from ASTROM_CACHE, or compute them with
+    erfa.apco13 (no refraction and no polar motion)
+    """
+    import erfa
+    key = (bucket, time_resolution, lat, lon, height, dut1)
+    astrom = ASTROM_CACHE.get(key)
+    if astrom is None:
+        mjd = (bucket + 0.5)*time_resolution/hsdate.DAYSEC
+        astrom, eo = erfa.apco13(hsdate.DJM0, mjd, dut1, numpy.radians(lon), numpy.radians(lat),
+                                 height, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+        if len(ASTROM_CACHE) >= 64:
+            ASTROM_CACHE.clear()
+        ASTROM_CACHE[key] = astrom
+    return astrom
+
+
+def get_radec_from_altaz_fast(alt, az, obstime, lat=SITE_LAT, lon=SITE_LON, height=SITE_HEIGHT,
+                              dut1=0.0, time_resolution=TIME_RESOLUTION):
+
+    """
+    Fast approximate ra, dec from the altitude/azimuth using ERFA directly,
+    without astropy and its IERS tables. The astrometry parameters are
+    cached per time bucket and only the Earth rotation angle is updated
+    for each obstime, with its own dut1.
+
+    The error is dominated by the UT1-UTC offset not known here: about
+    15*|dut1| arcsec in ra when dut1 is not given, which is below 14 arcsec
+    as |UT1-UTC| < 0.9 s (below 3 arcsec for 2020-2026). When dut1 is
+    given (i.e. Time.delta_ut1_utc) the error is below 0.5 arcsec, from the
+    neglected polar motion. The time bucketing adds less than 0.02 arcsec.
 
     Parameters
     ----------
 
-    alt : float
-        The Altitude (angle) for the object
-    az : float
-        The Azimuth (angle) for the object
-    obstime: float
-        The time of the observation
+    alt : float or array
+        The Altitude (angle) in degrees
+    az : float or array
+        The Azimuth (angle) in degrees
+    obstime: astropy Time, float or array
+        The time of the observation, or unix timestamps (UTC)
     lat: float
         Optional, the geographic latitude in degrees
     lon: float
         Optional, the geographic longitude in degrees
     height: float
         Optional, the height in meters
+    dut1: float or array
+        Optional, UT1-UTC in seconds, a single value or one per obstime
+        (i.e. Time.delta_ut1_utc for an array Time)
+    time_resolution: float
+        Optional, the time bucket in seconds for the cached astrometry
 
     Returns
     -------
 
-    ra: float
-       The Right Ascension
-    dec: float
+    ra: array
+       The Right Ascension in degrees
+    dec: array
+       The Declination in degrees
+    """
+
+    import erfa
+    utc1, utc2 = get_utc_jd(obstime)
+    alt, az, utc1, utc2, dut1 = numpy.broadcast_arrays(numpy.atleast_1d(alt), numpy.atleast_1d(az),
+                                                       utc1, utc2, numpy.atleast_1d(dut1).astype(float))
+    bucket = numpy.floor(((utc1 - hsdate.DJM0) + utc2)*hsdate.DAYSEC/time_resolution)
+    ra = numpy.empty(alt.shape)
+    dec = numpy.empty(alt.shape)
+    for b in numpy.unique(bucket):
+        sel = bucket == b
+        # dut1 only changes the Earth rotation angle of the astrometry,
+        # which aper13 sets for each obstime from its UT1, so the cached
+        # astrometry of the bucket does not depend on it
+        astrom = get_astrom(float(b), time_resolution, lat, lon, height, 0.0)
+        ut11, ut12 = erfa.utcut1(utc1[sel], utc2[sel], dut1[sel])
+        astrom = erfa.aper13(ut11, ut12, astrom)
+        ri, di = erfa.atoiq('A', numpy.radians(az[sel]), numpy.radians(90.0 - alt[sel]), astrom)
+        rc, dc = erfa.aticq(ri, di, astrom)
+        ra[sel] = numpy.degrees(erfa.anp(rc))
+        dec[sel] = numpy.degrees(dc)
+    return ra, dec
+
+
+def get_radec_from_altaz_batch(alt, az, obstime, lat=SITE_LAT, lon=SITE_LON, height=SITE_HEIGHT,
+                               time_resolution=TIME_RESOLUTION, fast=False, dut1=0.0):
+
+    """
+    Get the ra, dec for arrays of altitude/azimuth and times in a single
+    astropy transform. The site location is cached and, for more than
+    one obstime, the time-dependent astrometry is interpolated on a grid
+    of time_resolution seconds (astropy ErfaAstromInterpolator), which
+    adds an error below 1e-6 arcsec for 300 s.
+
+    Parameters
+    ----------
+
+    alt : float or array
+        The Altitude (angle) in degrees
+    az : float or array
+        The Azimuth (angle) in degrees
+    obstime: astropy Time, float or array
+        The time of the observation, or unix timestamps (UTC)
+    lat: float
+        Optional, the geographic latitude in degrees
+    lon: float
+        Optional, the geographic longitude in degrees
+    height: float
+        Optional, the height in meters
+    time_resolution: float
+        Optional, the time resolution in seconds, None to disable
+    fast: bool
+        Optional, use get_radec_from_altaz_fast() instead of astropy
+    dut1: float or array
+        Optional, UT1-UTC in seconds for the fast mode, a single value or
+        one per obstime
 
+    Returns
+    -------
 
+    ra: array
+       The Right Ascension in degrees
+    dec: array
+       The Declination in degrees
     """
 
-    # Get an astropy location object, using the appropiate astropy units
-    location = EarthLocation.from_geodetic(lon*u.deg, lat*u.deg, height*u.m)
+    if fast:
+        return get_radec_from_altaz_fast(alt, az, obstime, lat=lat, lon=lon, height=height,
+                                         dut1=dut1, time_resolution=time_resolution or TIME_RESOLUTION)
+
+    import astropy.units as u
+    from astropy.coordinates import AltAz, ICRS
+    from astropy.coordinates.erfa_astrom import erfa_astrom, ErfaAstromInterpolator
+    obstime = get_obstime(obstime)
     # Get an astropy coordinate of frame in the Altitude-Azimuth system
-    elaz = AltAz(alt=alt*u.deg, az=az*u.deg, obstime=obstime, location=location)
-    coords = elaz.transform_to(ICRS)
+    elaz = AltAz(alt=numpy.asarray(alt)*u.deg, az=numpy.asarray(az)*u.deg, obstime=obstime,
+                 location=get_location(lat, lon, height))
+    if time_resolution and obstime.size > 1:
+        with erfa_astrom.set(ErfaAstromInterpolator(time_resolution*u.s)):
+            coords = elaz.transform_to(ICRS())
+    else:
+        coords = elaz.transform_to(ICRS())
     return coords.ra.deg, coords.dec.deg
 
 
+def get_radec_from_altaz(alt, az, obstime, lat=SITE_LAT, lon=SITE_LON, height=SITE_HEIGHT,
+                         fast=False, dut1=0.0):
+
+    """
+    Get the ra, dec fron the altitude/azimuth and the telescope location
+    using the  astropy AltAz function
+
+    Parameters
+    ----------
+
+    alt : float or array
+        The Altitude (angle) for the object in degrees
+    az : float or array
+        The Azimuth (angle) for the object in degrees
+    obstime: astropy Time, float or array
+        The time of the observation, or unix timestamps in seconds (UTC).
+        Other types raise TypeError
+    lat: float
+        Optional, the geographic latitude in degrees
+    lon: float
+        Optional, the geographic longitude in degrees
+    height: float
+        Optional, the height in meters
+    fast: bool
+        Optional, use the approximate get_radec_from_altaz_fast()
+    dut1: float or array
+        Optional, UT1-UTC in seconds for the fast mode, a single value or
+        one per obstime
+
+    Returns
+    -------
+
+    ra: float or array
+       The Right Ascension in degrees, an array with the broadcast shape
+       of alt, az and obstime if any of them is an array
+    dec: float or array
+       The Declination in degrees, as ra
+
+    """
+
+    shape = numpy.broadcast_shapes(numpy.shape(alt), numpy.shape(az), get_obstime_shape(obstime))
+    ra, dec = get_radec_from_altaz_batch(alt, az, obstime, lat=lat, lon=lon, height=height,
+                                         fast=fast, dut1=dut1)
+    ra = numpy.reshape(ra, shape)
+    dec = numpy.reshape(dec, shape)
+    if shape == ():
+        return float(ra), float(dec)
+    return ra, dec
+
+
 if __name__ == "__main__":
+    from astropy.time import Time
     ra, dec = get_radec_from_altaz(alt=30, az=30, obstime=Time.now())
     print(ra, dec)
@@ -0,0 +1,531 @@
+# This file is part of HeaderService
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Compile the configuration of the HeaderService: read the yaml file, resolve
+the ${variable} values, validate the telemetry section and derive from it
+the channels, collection events and monitored channels (the plan) in a
+single place. The plan is immutable and can be cached on disk (opt-in, see
+--config_cache_dir) keyed by the hash of the config file, the values of its
+variables, the version and the source of the modules that compile and use
+the plan, so that restarts with the same configuration skip all of the
+derivation.
+"""
+
+import os
+import copy
+import json
+import types
+import hashlib
+import logging
+import functools
+import yaml
+import HeaderService
+from . import hsregex
+
+LOGGER = logging.getLogger(__name__)
+
+# Format version of the compiled plan, part of the cache keys
+PLAN_VERSION = 1
+
+# The modules that compile or use the plan, their source is part of the
+# cache keys so that a changed module never reads a stale plan
+SOURCE_MODULES = ('hsconfig.py', 'hsregex.py', 'hslib_salobj.py')
+
+# The fastest available yaml loader, same output as yaml.safe_load()
+YAML_CLOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# The allowed values for fixed collection events
+FIXED_COLLECTION_EVENTS = frozenset(["start_collection_event", "end_collection_event"])
+
+# The sections of the config that are replaced by their compiled version
+PLAN_CONFIG_KEYS = ('telemetry', 'start_collection_event', 'end_collection_event',
+                    'imageParam_event', 'cameraConf_event')
+
+# The allowed rules for monitored telemetry per monitor_mode
+MONITOR_VALID_RULES = {'event': frozenset(["min", "max", "latest"]),
+                       'buffer': frozenset(["min", "max", "latest", "mean"])}
+
+# The fields required for each telemetry keyword and per array type
+TELEMETRY_REQUIRED = ('device', 'Stype', 'topic', 'value', 'collect_after_event')
+ARRAY_REQUIRED = {'CCD_array': ('array_keys',),
+                  'CCD_array_str': ('array_keys',),
+                  'indexed_array': ('array_index',),
+                  'keyed_array': ('array_keyname', 'array_keys'),
+                  'enum': ('array_name',)}
+
+
+def get_cache_dir():
+    """The suggested directory for the cache of compiled configurations"""
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'HeaderService')
+
+
+@functools.lru_cache(maxsize=None)
+def get_source_hash():
+    """The sha256 hash of the source of the SOURCE_MODULES"""
+    digest = hashlib.sha256()
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    for name in SOURCE_MODULES:
+        with open(os.path.join(dirname, name), 'rb') as fobj:
+            digest.update(fobj.read())
+    return digest.hexdigest()
+
+
+def hash_key(*parts):
+    """The sha256 hash of the json representation of parts"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def freeze(obj):
+    """
+    Recursively convert the dictionaries of obj into read-only mappings
+    and the lists into tuples
+    """
+    if isinstance(obj, dict):
+        return types.MappingProxyType({key: freeze(val) for key, val in obj.items()})
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(val) for val in obj)
+    return obj
+
+
+def read_cache(cache_dir, key, log=LOGGER):
+    """Read the cached json for key, None if not found or unreadable"""
+    if not cache_dir:
+        return None
+    fname = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(fname) as fobj:
+            return json.load(fobj)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning(f"Cannot read config cache: {fname}: {e}")
+        return None
+
+
+def write_cache(cache_dir, key, data, log=LOGGER):
+    """
+    Write data as json for key, only if the json representation gives back
+    the same data. The file is replaced atomically
+    """
+    if not cache_dir:
+        return
+    fname = os.path.join(cache_dir, f"{key}.json")
+    try:
+        text = json.dumps(data)
+        if json.loads(text) != data:
+            log.warning(f"Config cannot be cached as json: {fname}")
+            return
+        os.makedirs(cache_dir, exist_ok=True)
+        tmpname = f"{fname}.{os.getpid()}.tmp"
+        with open(tmpname, 'w') as fobj:
+            fobj.write(text)
+        os.replace(tmpname, fname)
+    except (OSError, TypeError, ValueError) as e:
+        log.warning(f"Cannot write config cache: {fname}: {e}")
+
+
+def read_config_file(configfile, cache_dir=None, log=LOGGER):
+    """
+    Read the yaml configuration file. The parsed config is cached in
+    cache_dir keyed by the hash of the file content
+
+    Returns
+    -------
+    config: dict
+        The configuration read
+    source: SimpleNamespace
+        The file_hash and the names of the ${variables} in the file, to
+        be passed to compile_config()
+    """
+    with open(configfile, 'rb') as fobj:
+        raw = fobj.read()
+    file_hash = hashlib.sha256(raw).hexdigest()
+    var_names = sorted(set(hsregex.VAR_PATTERN.findall(raw.decode())))
+    source = types.SimpleNamespace(file_hash=file_hash, var_names=var_names)
+
+    key = hash_key('yaml', file_hash, HeaderService.__version__, PLAN_VERSION, get_source_hash())
+    config = read_cache(cache_dir, key, log)
+    if config is None:
+        config = yaml.load(raw, Loader=YAML_CLOADER)
+        write_cache(cache_dir, key, config, log)
+    return config, source
+
+
+def compile_config(config, source=None, cache_dir=None, log=LOGGER):
+    """
+    Compile the configuration dictionary (i.e. the command-line arguments
+    with the defaults of the config file): resolve the ${variables},
+    validate it and build the plan. When the source of the config file is
+    given, the plan is cached in cache_dir keyed by the hash of the file,
+    the values of its variables, playback, monitor_mode, the version and
+    the source of the SOURCE_MODULES.
+
+    Returns
+    -------
+    config: dict
+        The same config, with the variables resolved, the sections in
+        PLAN_CONFIG_KEYS replaced by their compiled (read-only) version
+        and the plan in 'compiled_plan'
+    """
+    key = None
+    plan = None
+    if source is not None:
+        variables = {name: config.get(name) for name in source.var_names}
+        key = hash_key('plan', source.file_hash, variables, config.get('playback'),
+                       config.get('monitor_mode'), HeaderService.__version__, PLAN_VERSION,
+                       get_source_hash())
+        plan = read_cache(cache_dir, key, log)
+
+    if plan is None:
+        hsregex.replace_variables_in_dict(config)
+        plan = compile_plan(config, log=log)
+        if key is not None:
+            write_cache(cache_dir, key, plan, log)
+    else:
+        # Only the values outside of the plan need to be resolved
+        others = {k: v for k, v in config.items() if k not in PLAN_CONFIG_KEYS}
+        config.update(hsregex.resolve_variables(others, dict(config)))
+    return apply_plan(config, plan)
+
+
+def apply_plan(config, plan):
+    """
+    Freeze the plan and replace the sections of config that are in the
+    plan by their compiled version
+    """
+    plan = freeze(plan)
+    for name in PLAN_CONFIG_KEYS:
+        if name in config:
+            config[name] = plan[name]
+    config['compiled_plan'] = plan
+    return config
+
+
+def compile_plan(config, log=LOGGER):
+    """
+    Validate the config and derive the channels, collection events and
+    monitored channels from copies of its telemetry and events
+
+    Returns
+    -------
+    plan: dict
+        The plan (json serializable)
+    """
+    validate_config(config, log=log)
+
+    telemetry = copy.deepcopy(config['telemetry'])
+    # Only for playback mode we remove all but the keywords to keep to
+    # block the HS from listeing to other CSCs
+    if config.get('playback'):
+        log.info("Playback mode, unsubscribing from telemetry")
+        keywords_keep = config.get('playback_keywords_keep', [])
+        for keyword in list(telemetry):
+            if keyword not in keywords_keep:
+                del telemetry[keyword]
+                log.info(f"Removing keyword: {keyword} from subscribed telemetry")
+
+    events = {name: copy.deepcopy(config.get(name)) for name in PLAN_CONFIG_KEYS[1:]}
+    channels, device_topics = extract_telemetry_channels(telemetry, **events)
+    (collection_events,
+     collection_events_names,
+     collection_events_keys) = get_collection_events(types.SimpleNamespace(telemetry=telemetry, **events))
+    valid_rules = MONITOR_VALID_RULES.get(config.get('monitor_mode'), MONITOR_VALID_RULES['event'])
+    (monitor_event_channels,
+     monitor_event_channels_names,
+     monitor_event_channels_keys) = get_monitor_channels(telemetry, valid_rules=valid_rules)
+
+    plan = {'telemetry': telemetry, **events,
+            'channels': channels,
+            'device_topics': device_topics,
+            'collection_events': collection_events,
+            'collection_events_names': collection_events_names,
+            'collection_events_keys': collection_events_keys,
+            'monitor_event_channels': monitor_event_channels,
+            'monitor_event_channels_names': monitor_event_channels_names,
+            'monitor_event_channels_keys': monitor_event_channels_keys,
+            'enum_csc': get_enum_cscs(telemetry)}
+    log.info(f"Compiled plan for {len(telemetry)} keywords and {len(channels)} channels")
+    return plan
+
+
+def validate_config(config, log=LOGGER):
+    """
+    Check that the config has the collection events and that the telemetry
+    keywords have the fields required by their array type. All errors are
+    logged and a ValueError is raised
+    """
+    errors = []
+    for name in ('telemetry', 'imageName_event', 'start_collection_event', 'end_collection_event'):
+        if not isinstance(config.get(name), dict):
+            errors.append(f"Missing or wrong definition of '{name}' in config")
+    for name in ('imageName_event', 'start_collection_event', 'end_collection_event',
+                 'imageParam_event', 'cameraConf_event'):
+        event = config.get(name)
+        if isinstance(event, dict) and not ('device' in event and 'topic' in event):
+            errors.append(f"Missing 'device' or 'topic' for '{name}' in config")
+
+    for keyword, telem in (config.get('telemetry') or {}).items():
+        if not isinstance(telem, dict):
+            errors.append(f"Wrong definition for keyword:{keyword}")
+            continue
+        required = TELEMETRY_REQUIRED + ARRAY_REQUIRED.get(telem.get('array'), ())
+        missing = [field for field in required if field not in telem]
+        if missing:
+            errors.append(f"Missing {missing} for keyword:{keyword}")
+        if telem.get('Stype', 'Event') not in ('Event', 'Telemetry'):
+            errors.append(f"Wrong Stype:{telem['Stype']} for keyword:{keyword}")
+        collect_after_event = telem.get('collect_after_event')
+        if isinstance(collect_after_event, dict):
+            if not ('device' in collect_after_event and 'topic' in collect_after_event):
+                errors.append(f"Missing 'device' or 'topic' in 'collect_after_event' for keyword:{keyword}")
+        elif collect_after_event is not None and collect_after_event not in FIXED_COLLECTION_EVENTS:
+            errors.append(f"Wrong definition 'collect_after_event' for keyword:{keyword}")
+
+    if errors:
+        for msg in errors:
+            log.error(msg)
+        raise ValueError(f"Invalid configuration: {len(errors)} error(s), first: {errors[0]}")
+
+
+def get_channel_name(c):
+    """ Standard formatting for the name of a channel across modules"""
+    # Assume index=0 if not defined
+    if 'device_index' not in c:
+        c['device_index'] = 0
+    return '{}_{}_{}'.format(c['device'], c['device_index'], c['topic'])
+
+
+def get_channel_device(c):
+    """ Standard formatting for the device name of a channel across modules"""
+    if 'device_index' not in c:
+        c['device_index'] = 0
+    return c['device']
+
+
+def get_channel_devname(c):
+    """ Standard formatting for the 'devname' of a channel across modules"""
+    if 'device_index' not in c:
+        c['device_index'] = 0
+    return "{}_{}".format(c['device'], c['device_index'])
+
+
+def get_channel_topic(c):
+    """ Standard formatting for the topic of a channel across modules"""
+    return c['topic']
+
+
+def collect_device_topics(c, device_topics):
+    """
+    Collect and update/augment topics for each device in the input
+    device_topics dictionary
+    """
+    devname = get_channel_devname(c)
+    topic = get_channel_topic(c)
+    device_topics.setdefault(devname, [])
+    if topic not in device_topics[devname]:
+        device_topics[devname].append(topic)
+    return device_topics
+
+
+def get_enum_cscs(telem):
+    """
+    Get only the enumerated devices described
+    in the telemetry section of the config
+    """
+    enum_cscs = []
+    for key in telem:
+        if 'array' in telem[key] and telem[key]['array'] == 'enum':
+            if telem[key]['device'] not in enum_cscs:
+                enum_cscs.append(telem[key]['device'])
+    return enum_cscs
+
+
+def get_collection_events(config):
+    """
+    Get the names of the collection event, where we want to collect telemetry
+    """
+
+    telem = config.telemetry
+    collection_events = {}
+    collection_events_names = []
+    collection_events_keys = {}
+    for key in telem:
+        # Extract the string or dictionary that for 'collect_after_event'
+        collect_after_event = telem[key]['collect_after_event']
+        # Case 1: it is one of the fixed collection events, so we get the info
+        # from the config section
+        if isinstance(collect_after_event, str) and collect_after_event in FIXED_COLLECTION_EVENTS:
+            collect_dict = getattr(config, collect_after_event)
+        # Case 2: it is a custom collection event, defined as a dictionary in
+        # the telemetry section of the config.
+        elif isinstance(collect_after_event, dict):
+            collect_dict = telem[key]['collect_after_event']
+        else:
+            msg = f"Wrong definition 'collect_after_event' for keyword:{key}"
+            raise ValueError(msg)
+
+        # Get the device and topic for collection event
+        device = collect_dict['device']
+        topic = collect_dict['topic']
+        name = get_channel_name(collect_dict)
+        # Append channel (i.e.: event name) if not in the list already
+        if name not in collection_events_names:
+            collection_events_names.append(name)
+            collection_events[name] = {'device': device, 'topic': topic,
+                                       'device_index': collect_dict['device_index']}
+            collection_events_keys[name] = [key]
+        else:
+            collection_events_keys[name].append(key)
+
+    return collection_events, collection_events_names, collection_events_keys
+
+
+def get_monitor_channels(telem, valid_rules=MONITOR_VALID_RULES['event']):
+    """
+    Get only events that we need to monitor
+    in the telemetry section of the config
+    """
+
+    monitor_event_channels_names = []
+    monitor_event_channels_keys = {}
+    monitor_event_channels = {}
+    for key in telem:
+        if 'monitor' in telem[key] and telem[key]['monitor'] is True:
+            # Extract rule and set to default value if not defined
+            if 'rule' not in telem[key]:
+                rule = 'latest'
+            else:
+                rule = telem[key]['rule']
+
+            if rule not in valid_rules:
+                msg = f"Wrong rule definition:{rule} for keyword:{key}"
+                raise ValueError(msg)
+
+            channel_name = get_channel_name(telem[key])
+            if channel_name not in monitor_event_channels_names:
+                monitor_event_channels_names.append(channel_name)
+                monitor_event_channels[channel_name] = telem[key]
+                monitor_event_channels_keys[channel_name] = [key]
+            else:
+                monitor_event_channels_keys[channel_name].append(key)
+    return monitor_event_channels, monitor_event_channels_names, monitor_event_channels_keys
+
+
+def extract_telemetry_channels(telem, start_collection_event=None,
+                               end_collection_event=None,
+                               imageParam_event=None,
+                               cameraConf_event=None):
+    """
+    Get the unique telemetry channels from telemetry dictionary to
+    define the topics that we need to subscribe to
+    """
+    channels = {}
+    device_topics = {}
+    for key in telem:
+        # Extract the string or dictionary that for 'collect_after_event'
+        collect_after_event = telem[key]['collect_after_event']
+        # Case 1: it is one of the fixed collection events
+        print(f"{key} -- collect_after_event: {collect_after_event}")
+        if isinstance(collect_after_event, str) and collect_after_event in FIXED_COLLECTION_EVENTS:
+            collect_dict = None
+
+        # Case 2: it is a custom collection event, defined as a dictionary in
+        # the telemetry section of the config.
+        elif isinstance(collect_after_event, dict):
+            collect_dict = telem[key]['collect_after_event']
+        else:
+            msg = f"Wrong definition 'collect_after_event' for keyword:{key}"
+            raise ValueError(msg)
+
+        # Add array qualifier -- REVISE or replace by array
+        if 'type' not in telem[key]:
+            telem[key]['type'] = 'scalar'
+        # Add default index=0 if undefined
+        if 'device_index' not in telem[key]:
+            telem[key]['device_index'] = 0
+        name = get_channel_name(telem[key])
+        # Make sure we don't create extra channels
+        if name not in channels.keys():
+            channels[name] = telem[key]
+        # Store the topics for the device
+        if collect_dict is not None:
+            device_topics = collect_device_topics(collect_dict, device_topics)
+        device_topics = collect_device_topics(telem[key], device_topics)
+
+    # We also need to make sure that we subscribe to the start/end
+    # collection Events in case these were not contained by the
+    if start_collection_event:
+        # Shortcut to variable c, note that when we update c
+        # we also update the end_collection_event dictionary
+        c = start_collection_event
+        # Assume index=0 if not defined
+        if 'device_index' not in c:
+            c['device_index'] = 0
+        name = get_channel_name(c)
+        if name not in channels.keys():
+            c['Stype'] = 'Event'
+            channels[name] = c
+        # Store the topics for the device
+        device_topics = collect_device_topics(c, device_topics)
+
+    if end_collection_event:
+        # Shortcut to variable c, note that when we update c
+        # we also update the end_collection_event dictionary
+        c = end_collection_event
+        # Assume index=0 if not defined
+        if 'device_index' not in c:
+            c['device_index'] = 0
+        name = get_channel_name(c)
+        if name not in list(channels.keys()):
+            c['Stype'] = 'Event'
+            channels[name] = c
+        # Store the topics for the device
+        device_topics = collect_device_topics(c, device_topics)
+
+    # The imageParam event
+    if imageParam_event:
+        c = imageParam_event
+        # Assume index=0 if not defined
+        if 'device_index' not in c:
+            c['device_index'] = 0
+        name = get_channel_name(c)
+        if name not in channels.keys():
+            c['Stype'] = 'Event'
+            channels[name] = c
+        # Store the topics for the device
+        device_topics = collect_device_topics(c, device_topics)
+
+    # The cameraConf_event event
+    if cameraConf_event:
+        c = cameraConf_event
+        # Assume index=0 if not defined
+        if 'device_index' not in c:
+            c['device_index'] = 0
+        name = get_channel_name(c)
+        if name not in channels.keys():
+            c['Stype'] = 'Event'
+            channels[name] = c
+        # Store the topics for the device
+        device_topics = collect_device_topics(c, device_topics)
+
+    return channels, device_topics
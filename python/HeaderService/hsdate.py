@@ -0,0 +1,319 @@
+# This file is part of HeaderService
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Lightweight conversion of unix timestamps (UTC) to ISOT strings and MJD
+floats for the header dates, without building an astropy.time.Time object.
+
+The two-part Julian Date is formed as astropy does for format='unix' and
+the calendar/time-of-day split follows the ERFA jd2cal and d2dtf routines,
+including the 86401 second days that end in a leap second, so the results
+are identical to Time(timeStamp, format='unix', scale='utc').isot/.mjd.
+Timestamps before 1972 (when UTC had rubber seconds) are passed to astropy.
+"""
+
+import math
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+# TAI-UTC in seconds from (year, month), as in erfa.leap_seconds.
+# This table needs a new entry every time IERS announces a leap second.
+LEAP_SECONDS = (
+    (1972, 1, 10.0),
+    (1972, 7, 11.0),
+    (1973, 1, 12.0),
+    (1974, 1, 13.0),
+    (1975, 1, 14.0),
+    (1976, 1, 15.0),
+    (1977, 1, 16.0),
+    (1978, 1, 17.0),
+    (1979, 1, 18.0),
+    (1980, 1, 19.0),
+    (1981, 7, 20.0),
+    (1982, 7, 21.0),
+    (1983, 7, 22.0),
+    (1985, 7, 23.0),
+    (1988, 1, 24.0),
+    (1990, 1, 25.0),
+    (1991, 1, 26.0),
+    (1992, 7, 27.0),
+    (1993, 7, 28.0),
+    (1994, 7, 29.0),
+    (1996, 1, 30.0),
+    (1997, 7, 31.0),
+    (1999, 1, 32.0),
+    (2006, 1, 33.0),
+    (2009, 1, 34.0),
+    (2012, 7, 35.0),
+    (2015, 7, 36.0),
+    (2017, 1, 37.0),
+)
+
+DAYSEC = 86400.0
+# MJD zero point and the unix epoch (1970-01-01 00:00:00) as a two-part JD
+DJM0 = 2400000.5
+UNIX_EPOCH_JD = (2440588.0, -0.5)
+# 1972-01-01 00:00:00 UTC, start of the LEAP_SECONDS table
+UNIX_LEAP_START = 63072000.0
+DBL_EPSILON = 2.220446049250313e-16
+
+
+def two_sum(a, b):
+    """Add a and b exactly, returning the sum and its rounding error"""
+    x = a + b
+    eb = x - a
+    ea = x - eb
+    eb = b - eb
+    ea = a - ea
+    return x, ea + eb
+
+
+def two_product(a, b):
+    """Multiply a and b exactly, returning the product and its error"""
+    x = a * b
+    c = 134217729.0 * a
+    ah = c - (c - a)
+    al = a - ah
+    c = 134217729.0 * b
+    bh = c - (c - b)
+    bl = b - bh
+    y = x - ah * bh
+    y -= al * bh
+    y -= ah * bl
+    y = al * bl - y
+    return x, y
+
+
+def sign(x):
+    "Sign of x as -1, 0 or 1"
+    return (x > 0) - (x < 0)
+
+
+def dnint(x):
+    """Round to nearest whole number, half away from zero (ERFA_DNINT)"""
+    if abs(x) < 0.5:
+        return 0.0
+    if x < 0.0:
+        return math.ceil(x - 0.5)
+    return math.floor(x + 0.5)
+
+
+def unix_to_jd(timeStamp):
+    """
+    Get the two-part UTC Julian Date (jd1, jd2) of a unix timestamp,
+    with the same arithmetic as astropy's day_frac() for format='unix'
+
+    Parameters
+    ----------
+    timeStamp : float
+        Seconds since 1970-01-01 00:00:00 UTC
+
+    Returns
+    -------
+    jd1, jd2 : float
+        The integer and fractional (-0.5 <= jd2 <= 0.5) parts of the JD
+    """
+    sum12 = float(timeStamp)
+    err12 = 0.0
+    q1 = sum12 / DAYSEC
+    p1, p2 = two_product(q1, DAYSEC)
+    d1, d2 = two_sum(sum12, -p1)
+    d2 += err12
+    d2 -= p2
+    q2 = (d1 + d2) / DAYSEC
+    sum12, err12 = two_sum(q1, q2)
+
+    day = float(round(sum12))
+    frac, check = two_sum(sum12 - day, err12)
+    if frac * sign(check) != 0.5:
+        day += round(frac)
+    else:
+        day += round(frac + 2 * check)
+    frac = sum12 - day
+    frac += err12
+
+    jd1 = UNIX_EPOCH_JD[0] + day
+    jd2 = UNIX_EPOCH_JD[1] + frac
+    extra = round(jd2)
+    return jd1 + extra, jd2 - extra
+
+
+def jd_to_calendar(dj1, dj2):
+    """
+    Get the Gregorian calendar date and fraction of day of a two-part
+    Julian Date, following ERFA jd2cal
+
+    Returns
+    -------
+    (iy, im, id, fd) : tuple
+        The year, month, day and fraction of day
+    """
+    d = dnint(dj1)
+    f1 = dj1 - d
+    jd = int(d)
+    d = dnint(dj2)
+    f2 = dj2 - d
+    jd += int(d)
+
+    # Compute f1+f2+0.5 using compensated summation
+    s = 0.5
+    cs = 0.0
+    for x in (f1, f2):
+        t = s + x
+        cs += (s - t) + x if abs(s) >= abs(x) else (x - t) + s
+        s = t
+        if s >= 1.0:
+            jd += 1
+            s -= 1.0
+    f = s + cs
+    cs = f - s
+
+    # Deal with negative f
+    if f < 0.0:
+        f = s + 1.0
+        cs += (1.0 - f) + s
+        s = f
+        f = s + cs
+        cs = f - s
+        jd -= 1
+
+    # Deal with f that is 1.0 or more (when rounded to double)
+    if (f - 1.0) >= -DBL_EPSILON/4.0:
+        t = s - 1.0
+        cs += (s - t) - 1.0
+        s = t
+        f = s + cs
+        if -DBL_EPSILON/2.0 < f:
+            jd += 1
+            f = max(f, 0.0)
+
+    iy, im, id = jd_to_ymd(jd)
+    return iy, im, id, f
+
+
+def jd_to_ymd(jd):
+    """Gregorian year, month and day of the integer Julian Day Number"""
+    l = jd + 68569  # noqa: E741
+    n = (4 * l) // 146097
+    l -= (146097 * n + 3) // 4  # noqa: E741
+    i = (4000 * (l + 1)) // 1461001
+    l -= (1461 * i) // 4 - 31  # noqa: E741
+    k = (80 * l) // 2447
+    id = l - (2447 * k) // 80
+    l = k // 11  # noqa: E741
+    im = k + 2 - 12 * l
+    iy = 100 * (n - 49) + i + l
+    return iy, im, id
+
+
+def tai_utc(iy, im):
+    """TAI-UTC in seconds at the start of a month from 1972 onwards"""
+    dat = LEAP_SECONDS[0][2]
+    for (year, month, value) in LEAP_SECONDS:
+        if (iy, im) < (year, month):
+            break
+        dat = value
+    return dat
+
+
+def jd_to_isot(jd1, jd2, precision=3):
+    """
+    Format a two-part UTC Julian Date as an ISOT string, following ERFA
+    d2dtf, where days ending in a leap second are 86401 seconds long and
+    the last second is printed as 23:59:60.
+
+    Parameters
+    ----------
+    jd1, jd2 : float
+        The two-part UTC Julian Date
+    precision : int
+        Number of decimal places for the seconds
+
+    Returns
+    -------
+    isot : str
+        The date in the 'YYYY-MM-DDTHH:MM:SS.sss' format
+    """
+    iy, im, id, fd = jd_to_calendar(jd1, jd2)
+
+    # Is this a leap second day?
+    dat0 = tai_utc(iy, im)
+    ny, nm, nd, _ = jd_to_calendar(jd1 + 1.5, jd2 - fd)
+    dleap = tai_utc(ny, nm) - dat0
+    leap = abs(dleap) > 0.5
+    if leap:
+        fd += fd * dleap/DAYSEC
+
+    # Round the time of day, in resolution units, as ERFA d2tf
+    rs = 10 ** precision
+    a = dnint(rs * (DAYSEC * abs(fd)))
+    ah = math.floor(a / (rs * 3600))
+    a -= ah * rs * 3600
+    am = math.floor(a / (rs * 60))
+    a -= am * rs * 60
+    sec = math.floor(a / rs)
+    frac = a - sec * rs
+    hour, minute = int(ah), int(am)
+
+    # Has the (rounded) time gone past 24h?
+    if hour > 23:
+        if not leap or sec > 0:
+            # Use 0h tomorrow
+            iy, im, id = ny, nm, nd
+            hour = minute = sec = frac = 0
+        else:
+            # Use 23:59:60 today
+            hour, minute, sec = 23, 59, 60
+
+    isot = f"{iy:d}-{im:02d}-{id:02d}T{hour:02d}:{minute:02d}:{int(sec):02d}"
+    if precision > 0:
+        isot += f".{int(frac):0{precision}d}"
+    return isot
+
+
+def get_date_astropy(timeStamp):
+    "Get the isot and mjd of a timestamp using astropy.time"
+    from astropy.time import Time
+    t = Time(timeStamp, format='unix', scale='utc')
+    return t.isot, float(t.mjd)
+
+
+def get_isot_mjd(timeStamp):
+    """
+    Get the UTC ISOT string and MJD float of a unix timestamp, identical to
+    astropy's Time(timeStamp, format='unix', scale='utc').isot and .mjd
+
+    Parameters
+    ----------
+    timeStamp : float
+        Seconds since 1970-01-01 00:00:00 UTC
+
+    Returns
+    -------
+    isot, mjd : str, float
+        The date in 'YYYY-MM-DDTHH:MM:SS.sss' format and the MJD
+    """
+    timeStamp = float(timeStamp)
+    if not math.isfinite(timeStamp) or timeStamp < UNIX_LEAP_START:
+        return get_date_astropy(timeStamp)
+    jd1, jd2 = unix_to_jd(timeStamp)
+    return jd_to_isot(jd1, jd2), (jd1 - DJM0) + jd2
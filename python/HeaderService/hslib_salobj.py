@@ -20,28 +20,52 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import io
 import sys
 import socket
 import asyncio
 import time
 import types
 import subprocess
+import concurrent.futures
+import contextlib
+import functools
 from . import hutils
-from . import hscalc
+from . import hsdate
+from . import hsconfig
+# The channel helpers moved to hsconfig, they are re-exported here
+from .hsconfig import (get_channel_name, get_channel_device, get_channel_devname,  # noqa: F401
+                       get_channel_topic, collect_device_topics, get_enum_cscs,
+                       get_collection_events, get_monitor_channels, extract_telemetry_channels)
 from lsst.ts import salobj
 import HeaderService
 import importlib
+import importlib.util
 import json
 import copy
 import logging
+import numpy
+import numbers
 
 try:
     HEADERSERVICE_DIR = os.environ['HEADERSERVICE_DIR']
 except KeyError:
     HEADERSERVICE_DIR = __file__.split('python')[0]
 
-# The allowed values for fixed collection events
-FIXED_COLLECTION_EVENTS = frozenset(["start_collection_event", "end_collection_event"])
+# The rules to update the monitored keywords: rule(current, latest)
+MONITOR_RULES = {'latest': lambda current, latest: latest, 'max': max, 'min': min}
+
+# The reductions of the monitored keywords over the START-END window of
+# samples in monitor_mode: 'buffer'. Keywords with the 'latest' rule keep
+# the last value rather than a ring buffer of samples
+MONITOR_REDUCTIONS = {'latest': lambda values: values[-1], 'max': numpy.max, 'min': numpy.min,
+                      'mean': numpy.mean}
+
+# The number of images kept in HSWorker.image_loop_times
+MAX_IMAGE_LOOP_TIMES = 128
+
+# The stages of the END pipeline in order, and their default concurrency
+END_CONCURRENCY = {'collect': 1, 'render': 1, 'persist': 1, 'publish': 2}
 
 
 class HSWorker(salobj.BaseCsc):
@@ -56,31 +80,67 @@ class HSWorker(salobj.BaseCsc):
         # Load the configurarion
         self.config = types.SimpleNamespace(**keys)
 
+        # The time in seconds spent in each of the startup phases
+        self.startup_times = {}
+
+        # The time in seconds that the last images blocked the event loop,
+        # see record_loop_time()
+        self.image_loop_times = {}
+
         # Create a salobj.BaseCsc and get logger
-        self.create_BaseCsc()
+        self.run_startup_phase(self.create_BaseCsc)
 
         # Get ready non-SAL related tasks
-        self.prepare()
+        self.run_startup_phase(self.prepare)
 
         # Extract the unique channel by topic/device
-        self.get_channels()
+        self.run_startup_phase(self.get_channels)
 
         # Make the connections using saloj.Remote
-        self.create_Remotes()
+        self.run_startup_phase(self.create_Remotes)
 
         # Define the callbacks for start/end
-        self.define_evt_callbacks()
+        self.run_startup_phase(self.define_evt_callbacks)
 
         # Load enum xml libraries
-        self.load_enums_xml()
+        self.run_startup_phase(self.load_enums_xml)
+
+        # Compile the plans to collect the telemetry keywords
+        self.run_startup_phase(self.compile_collection_plans)
+
+        # Keep the latest values from callbacks in push collect_mode
+        if self.config.collect_mode == 'push':
+            self.define_latest_callbacks()
 
-        # Define global lock to update dictionaries
+        # Keep the samples of monitored keywords in buffer monitor_mode
+        if self.config.monitor_mode == 'buffer':
+            self.create_monitor_buffers()
+
+        # Define the shared lock for the CSC-wide state; the per-image data
+        # structures are guarded by the locks in self.image_lock
         self.dlock = asyncio.Lock()
 
+        # The END pipeline workers are started with the first END event
+        self.end_workers = []
+        self.log.info(f"Startup times: {self.format_startup_times()}")
+
+    def run_startup_phase(self, phase):
+        """Run a startup phase and record its time in self.startup_times"""
+        t0 = time.time()
+        phase()
+        self.startup_times[phase.__name__] = time.time() - t0
+
+    def format_startup_times(self):
+        """Format the startup times per phase in ms"""
+        return ", ".join(f"{name}: {1e3*t:.1f}[ms]" for name, t in self.startup_times.items())
+
     async def close_tasks(self):
-        """Close tasks on super and evt timeout"""
+        """Close tasks on super, evt timeout and the END pipeline"""
         await super().close_tasks()
-        self.cancel_timeout_tasks()
+        self.cancel_end_pipeline()
+        await self.cancel_timeout_tasks()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
 
     async def end_evt_timeout(self, imageName, timeout):
         """Timeout timer for end event telemetry callback"""
@@ -88,18 +148,24 @@ class HSWorker(salobj.BaseCsc):
         self.log.info(f"{self.name_end} for {imageName} not seen in {timeout} [s]; giving up")
         # Send the timeout warning using the salobj log
         self.log.warning(f"Timeout while waiting for {self.name_end} Event from {imageName}")
-        async with self.dlock:
+        async with self.lock_image(imageName):
             self.clean(imageName)
 
-    def cancel_timeout_tasks(self):
-        """Cancel the per-image timeout tasks"""
+    async def cancel_timeout_tasks(self):
+        """
+        Cancel the per-image timeout tasks, and clean the images with
+        their lock, so a stage of the END pipeline running for an image
+        finishes before its data is gone
+        """
         # Get the imageName to cancel
         list_to_cancel = copy.deepcopy(list(self.end_evt_timeout_task.keys()))
         if list_to_cancel:
             self.log.info(f"Will cancel tasks: {list_to_cancel}")
             for imageName in list_to_cancel:
-                self.end_evt_timeout_task[imageName].cancel()
-                self.clean(imageName)
+                if imageName in self.end_evt_timeout_task:
+                    self.end_evt_timeout_task[imageName].cancel()
+                async with self.lock_image(imageName):
+                    self.clean(imageName)
 
     async def handle_summary_state(self):
 
@@ -117,11 +183,13 @@ class HSWorker(salobj.BaseCsc):
         self.log.info(f"Current state is: {self.current_state.name}; transition to {self.summary_state.name}")
 
         if self.summary_state != salobj.State.ENABLED:
-            self.cancel_timeout_tasks()
+            await self.cancel_timeout_tasks()
 
         # Check that services are running -- if not will go into FAULT
         if (self.current_state == salobj.State.DISABLED) and (self.summary_state == salobj.State.ENABLED):
             await self.check_services()
+            # Import the enum libraries before the first image needs them
+            self.import_xml_libs()
 
         self.log.info(f"Current state is: {self.summary_state.name}")
         # Save the current_state for next
@@ -193,10 +261,13 @@ class HSWorker(salobj.BaseCsc):
             # The keywords we want to update
             keywords = self.monitor_event_channels_keys[monitor_event_name]
             self.log.info(f"Collecting metadata for: {monitor_event_name} and keys: {keywords}")
-            # Update the imageName metadata with new dict
-            for imageName in self.metadata.keys():
-                self.log.info(f"Updating monitored metadata for: {imageName}")
-                self.update_monitor_metadata(imageName, keywords)
+            # Only record the samples, they are reduced at END
+            if self.config.monitor_mode == 'buffer':
+                self.record_monitor_samples(keywords)
+                return
+            # Update the metadata of all imageNames with one collection
+            self.log.info(f"Updating monitored metadata for: {list(imageName_list)}")
+            self.update_monitor_metadata(list(imageName_list), keywords)
 
         return generic_monitor_callback
 
@@ -270,8 +341,8 @@ class HSWorker(salobj.BaseCsc):
         self.log.info(f"Calling cancel() timeout_task for: {imageName}")
         self.end_evt_timeout_task[imageName].cancel()
 
-        # Final collection using asyncio lock, will call functions that
-        # take care of updating data structures. We also write the header file.
+        # Queue the image into the END pipeline, which does the final
+        # collection and writes the header.
         asyncio.ensure_future(self.complete_tasks_END(imageName))
 
     def get_playlist_dir(self):
@@ -302,7 +373,8 @@ class HSWorker(salobj.BaseCsc):
         else:
             # Try to auto-figure out from location
             self.log.warning("The TSTAND was not defined in config/environment")
-            address = socket.getfqdn()
+            # The lookup failed in discover_host() if None
+            address = get_fqdn() or ''
             if address.find('.ncsa.') >= 0:
                 self.tstand = "NCSA"
                 self.log.info(f"Will use auto-config tstand: {self.tstand}")
@@ -320,9 +392,13 @@ class HSWorker(salobj.BaseCsc):
         elif 'IP_HEADERSERVICE' in os.environ:
             self.ip_address = os.environ['IP_HEADERSERVICE']
             self.log.info(f"Will use IP: {self.ip_address} fron environment for web service")
-        else:
-            self.ip_address = socket.gethostbyname(socket.gethostname())
+        elif get_host_ip() is not None:
+            self.ip_address = get_host_ip()
             self.log.info(f"Will use IP: {self.ip_address} auto-config for web service")
+        else:
+            # The lookup failed in discover_host()
+            self.ip_address = '127.0.0.1'
+            self.log.warning(f"Cannot auto-config IP, will use: {self.ip_address} for web service")
 
     def get_s3instance(self):
         """
@@ -341,7 +417,8 @@ class HSWorker(salobj.BaseCsc):
 
         # Try to auto-figure out from location
         self.log.warning("The s3instance was not defined in config")
-        address = socket.getfqdn()
+        # The lookup failed in discover_host() if None
+        address = get_fqdn() or ''
         if address.find('.ncsa.') >= 0:
             s3instance = 'nts'
         elif address.find('tuc') >= 0:
@@ -493,17 +570,6 @@ class HSWorker(salobj.BaseCsc):
         self.log.info(f"Setting simulationMode Event with mode: {self.config.hs_simulation_mode}")
         self.evt_simulationMode.set(mode=self.config.hs_simulation_mode)
 
-        # Only for playback mode we remove all but one entry from the
-        # self.config.telemetry to block the HS from listeing to other CSCs
-        if self.config.playback:
-            # keywords_keep = ['EMUIMAGE', 'DATE-OBS', 'DATE-BEG', 'DATE-END']
-            self.log.info("Playback mode, unsubscribing from telemetry")
-            telemetry_copy = self.config.telemetry.copy()
-            for keyword in telemetry_copy:
-                if keyword not in self.config.playback_keywords_keep:
-                    del self.config.telemetry[keyword]
-                    self.log.info(f"Removing keyword: {keyword} from subscribed telemetry")
-
     def create_Remotes(self):
         """
         Create the Remotes to collect telemetry/Events for channels as
@@ -515,6 +581,8 @@ class HSWorker(salobj.BaseCsc):
         # The dict containing all of the threads and connections
         self.Remote = {}
         self.Remote_get = {}
+        # The readiness of the Remotes per device, see start_Remotes()
+        self.Remote_ready = {}
         for channel_name, c in self.channels.items():
             devname = get_channel_devname(c)
             # Make sure we only create these once
@@ -524,7 +592,9 @@ class HSWorker(salobj.BaseCsc):
                                                      name=c['device'],
                                                      index=c['device_index'],
                                                      include=self.device_topics[devname],
+                                                     start=False,
                                                      )
+                self.Remote_ready[devname] = False
                 self.log.info(f"Created Remote for {devname}")
                 self.log.info(f"with include topics: {self.device_topics[devname]}")
 
@@ -536,34 +606,116 @@ class HSWorker(salobj.BaseCsc):
                 self.Remote_get[channel_name] = getattr(self.Remote[devname], f"tel_{c['topic']}").get
                 self.log.info(f"Storing Remote.tel_{c['topic']}.get() for {channel_name}")
 
+    async def start_Remotes(self):
+        """
+        Start the Remotes of all devices concurrently, so the time to get
+        ready does not scale with the number of devices
+        """
+        t0 = time.time()
+        await asyncio.gather(*[self.start_Remote(devname) for devname in self.devices])
+        self.startup_times['start_Remotes'] = time.time() - t0
+        ready = [devname for devname in self.devices if self.Remote_ready[devname]]
+        self.log.info(f"Remotes ready: {len(ready)}/{len(self.devices)} in {hutils.elapsed_time(t0)}")
+
+    async def start_Remote(self, devname):
+        """Start the Remote for devname and report when it is ready"""
+        t0 = time.time()
+        try:
+            await self.Remote[devname].start()
+        except Exception as e:
+            self.log.error(f"Cannot start Remote for {devname}: {e}")
+            return
+        self.Remote_ready[devname] = True
+        self.log.info(f"Remote for {devname} ready in {hutils.elapsed_time(t0)}")
+
+    async def discover_host(self):
+        """
+        Resolve the fully qualified name and IP address of the host, once
+        and in threads, when they are needed to auto-configure the tstand,
+        ip_address or s3instance. A failed lookup is cached as None, so it
+        is not tried again in the event loop
+        """
+        t0 = time.time()
+        auto_tstand = not (self.config.tstand or 'TSTAND_HEADERSERVICE' in os.environ)
+        auto_s3instance = not (self.config.s3instance or 'S3INSTANCE' in os.environ)
+        auto_ip = not (self.config.ip_address or 'IP_HEADERSERVICE' in os.environ)
+        lookups = []
+        if auto_tstand or (self.config.lfa_mode == 's3' and auto_s3instance):
+            lookups.append(get_fqdn)
+        if self.config.lfa_mode == 'http' and auto_ip:
+            lookups.append(get_host_ip)
+        if lookups:
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(*[loop.run_in_executor(None, lookup) for lookup in lookups])
+            for lookup, result in zip(lookups, results):
+                if result is None:
+                    self.log.warning(f"Host discovery with {lookup.__name__}() failed, will use defaults")
+        self.startup_times['discover_host'] = time.time() - t0
+
+    async def start(self):
+        """
+        Start the CSC, the Remotes and the host discovery, which are
+        awaited concurrently before the CSC is ready
+        """
+        await super().start()
+        await asyncio.gather(self.start_Remotes(), self.discover_host())
+        # Seed the latest values with the data the Remotes already have
+        if self.config.collect_mode == 'push':
+            self.seed_latest_values()
+        # Get the TSTAND
+        self.get_tstand()
+
     def load_enums_xml(self):
         """
-        Load using importlib the xml libraries for the enumerated CSCs
+        Find the xml libraries for the enumerated CSCs. The libraries are
+        only imported the first time that they are used, see get_xml_lib()
         """
         # Get the list of enum enum_csc
         self.log.info("Extracting enum CSC's from telemetry dictionary")
-        self.enum_csc = get_enum_cscs(self.config.telemetry)
+        self.enum_csc = self.config.compiled_plan['enum_csc']
+        self.enum_keywords = set(k for k, c in self.config.telemetry.items() if c.get('array') == 'enum')
         self.xml_lib = {}
         for csc in self.enum_csc:
+            if importlib.util.find_spec(f"lsst.ts.xml.enums.{csc}") is None:
+                msg = f"Cannot find enum library lsst.ts.xml.enums.{csc}"
+                self.log.error(msg)
+                raise ModuleNotFoundError(msg)
+        self.log.info(f"enums found for: {self.enum_csc}")
+
+    def import_xml_libs(self):
+        """Import the xml enum libraries that have not been used yet"""
+        for csc in self.enum_csc:
+            self.get_xml_lib(csc)
+
+    def get_xml_lib(self, csc):
+        """Get the xml enum library for csc, importing it on first use"""
+        xml_lib = self.xml_lib.get(csc)
+        if xml_lib is None:
             self.log.info(f"importing lsst.ts.xml.enums.{csc}")
-            self.xml_lib[csc] = importlib.import_module("lsst.ts.xml.enums.{}".format(csc))
-        self.log.info("enums imported")
+            xml_lib = importlib.import_module(f"lsst.ts.xml.enums.{csc}")
+            self.xml_lib[csc] = xml_lib
+        return xml_lib
 
     def get_channels(self):
         """Extract the unique channels by topic/device"""
+        # The plan compiled by bin/headerservice (see hsconfig), or compiled
+        # here when the HSWorker is created from a plain config
+        if self.config.compiled_plan is None:
+            self.log.info("Compiling the telemetry dictionary")
+            hsconfig.apply_plan(vars(self.config), hsconfig.compile_plan(vars(self.config), log=self.log))
+        plan = self.config.compiled_plan
+        if self.config.playback:
+            self.log.info(f"Playback mode, subscribed to telemetry: {list(self.config.telemetry)}")
+
         self.log.info("Extracting Telemetry channels and topics from telemetry dictionary")
-        self.channels, self.device_topics = extract_telemetry_channels(
-            self.config.telemetry,
-            start_collection_event=self.config.start_collection_event,
-            end_collection_event=self.config.end_collection_event,
-            imageParam_event=self.config.imageParam_event,
-            cameraConf_event=self.config.cameraConf_event)
+        self.channels = plan['channels']
+        self.device_topics = plan['device_topics']
 
         # Get the events where we want to collect telemetry
         self.log.info("Extracting collection events from telemetry dictionary")
-        (self.collection_events,
-         self.collection_events_names,
-         self.collection_events_keys) = get_collection_events(self.config)
+        self.collection_events = plan['collection_events']
+        self.collection_events_names = plan['collection_events_names']
+        self.collection_events_keys = plan['collection_events_keys']
         self.log.info(f"Extracted events to collect: {self.collection_events_names}")
 
         # Select the start_collection channel
@@ -577,9 +729,9 @@ class HSWorker(salobj.BaseCsc):
 
         # Get the events we want to monitor
         self.log.info("Extracting Telemetry channels to monitor from telemetry dictionary")
-        (self.monitor_event_channels,
-         self.monitor_event_channels_names,
-         self.monitor_event_channels_keys) = get_monitor_channels(self.config.telemetry)
+        self.monitor_event_channels = plan['monitor_event_channels']
+        self.monitor_event_channels_names = plan['monitor_event_channels_names']
+        self.monitor_event_channels_keys = plan['monitor_event_channels_keys']
         if len(self.monitor_event_channels) > 0:
             self.log.info(f"Extracted channels to monitor: {self.monitor_event_channels_names}")
 
@@ -627,8 +779,8 @@ class HSWorker(salobj.BaseCsc):
         # Make sure that we have a place to put the files
         self.check_outdir(self.config.filepath)
 
-        # Get the TSTAND
-        self.get_tstand()
+        # The TSTAND is defined in start(), after the host discovery
+        self.tstand = None
 
         # Get the playlist directory
         if self.config.playback:
@@ -637,6 +789,9 @@ class HSWorker(salobj.BaseCsc):
         # Create dictionaries keyed to imageName
         self.create_dicts()
 
+        # The cache of the Camera configuration, see read_camera_vendors()
+        self.camera_conf_cache = {}
+
         # Define if we need sensor infornation in templates
         # For LSSTCam, MTCamera is charge the Camera metadata
         # if self.config.instrument == 'LSSTCam':
@@ -655,37 +810,171 @@ class HSWorker(salobj.BaseCsc):
             self.log.info("Setting imageParam_event to None")
             self.config.imageParam_event = None
 
+        # Check for the compiled plan of the configuration, see hsconfig
+        if not hasattr(self.config, 'compiled_plan'):
+            self.log.info("Setting compiled_plan to None")
+            self.config.compiled_plan = None
+
+        # Check for the yaml emitter in configuration
+        if not hasattr(self.config, 'yaml_emitter'):
+            self.log.info("Setting yaml_emitter to native")
+            self.config.yaml_emitter = 'native'
+
+        # Check for the FITS writer in configuration
+        if not hasattr(self.config, 'fits_writer'):
+            self.log.info("Setting fits_writer to native")
+            self.config.fits_writer = 'native'
+
+        # Check for the executor used to write and checksum the headers
+        if not hasattr(self.config, 'executor'):
+            self.log.info("Setting executor to thread")
+            self.config.executor = 'thread'
+        if not hasattr(self.config, 'executor_workers'):
+            self.log.info("Setting executor_workers to 1")
+            self.config.executor_workers = 1
+        self.create_executor()
+
+        # Check for the telemetry collect mode: 'pull' or 'push'
+        if not hasattr(self.config, 'collect_mode'):
+            self.log.info("Setting collect_mode to pull")
+            self.config.collect_mode = 'pull'
+        if self.config.collect_mode not in ('pull', 'push'):
+            msg = f"collect_mode: {self.config.collect_mode} not supported"
+            self.log.error(msg)
+            raise ValueError(msg)
+
+        # Check for the monitor mode: 'event' or 'buffer'
+        if not hasattr(self.config, 'monitor_mode'):
+            self.log.info("Setting monitor_mode to event")
+            self.config.monitor_mode = 'event'
+        if self.config.monitor_mode not in ('event', 'buffer'):
+            msg = f"monitor_mode: {self.config.monitor_mode} not supported"
+            self.log.error(msg)
+            raise ValueError(msg)
+        if not hasattr(self.config, 'monitor_buffer_size'):
+            self.log.info("Setting monitor_buffer_size to 1024")
+            self.config.monitor_buffer_size = 1024
+
+        # Check for the END pipeline queue size and stage concurrency
+        if not hasattr(self.config, 'end_queue_size'):
+            self.log.info("Setting end_queue_size to 4")
+            self.config.end_queue_size = 4
+        if not hasattr(self.config, 'end_concurrency'):
+            self.config.end_concurrency = {}
+        self.config.end_concurrency = {**END_CONCURRENCY, **self.config.end_concurrency}
+        self.log.info(f"Setting end_concurrency to: {self.config.end_concurrency}")
+
         self.log.info(f"Setting nosensors to: {self.nosensors} for {self.config.instrument}")
 
+    def create_executor(self):
+        """
+        Create the executor that runs the header rendering, writing and
+        checksum off the event loop: 'thread' or 'none' to run them in the
+        event loop. There is no process pool, as the HDRTEMPL would be
+        pickled for every image, and the caches in hutils are keyed by the
+        id() of the objects of this process
+        """
+        if self.config.executor == 'thread':
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.executor_workers)
+        elif self.config.executor == 'none':
+            self.executor = None
+        else:
+            msg = f"executor: {self.config.executor} not supported"
+            self.log.error(msg)
+            raise ValueError(msg)
+        self.log.info(f"Will use executor: {self.config.executor} "
+                      f"with {self.config.executor_workers} worker(s)")
+
+    async def run_blocking(self, imageName, func, *args):
+        """
+        Run a blocking function in the executor and wait for it. Without an
+        executor it runs in the event loop and its time is added to the
+        event loop blocking time of imageName
+        """
+        if self.executor is None:
+            t0 = time.time()
+            result = func(*args)
+            self.add_loop_time(imageName, t0)
+            return result
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def add_loop_time(self, imageName, t0):
+        """Add the time since t0 to the event loop time for imageName"""
+        self.loop_time[imageName] = self.loop_time.get(imageName, 0) + time.time() - t0
+
+    def record_loop_time(self, imageName):
+        """
+        Record the event loop blocking time of imageName in
+        self.image_loop_times, which keeps the last MAX_IMAGE_LOOP_TIMES
+        images, and log it in the format of the startup times
+        """
+        if len(self.image_loop_times) >= MAX_IMAGE_LOOP_TIMES:
+            del self.image_loop_times[next(iter(self.image_loop_times))]
+        self.image_loop_times[imageName] = self.loop_time.get(imageName, 0)
+        self.log.info(f"Event loop blocking time for {imageName}: "
+                      f"{1e3*self.image_loop_times[imageName]:.1f}[ms]")
+
+    @contextlib.asynccontextmanager
+    async def lock_image(self, imageName):
+        """
+        Hold the asyncio lock for imageName, so START and END for different
+        images can overlap while they are serialized for the same image.
+        The lock is dropped from self.image_lock once it is released and
+        no one else is waiting for it, so a clean() under the lock cannot
+        hand out a second lock for the same image. The image data could be
+        gone once the lock is acquired.
+        """
+        if imageName not in self.image_lock:
+            self.image_lock[imageName] = asyncio.Lock()
+            self.image_lock_users[imageName] = 0
+        lock = self.image_lock[imageName]
+        self.image_lock_users[imageName] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.image_lock_users[imageName] -= 1
+            if self.image_lock_users[imageName] == 0:
+                del self.image_lock[imageName]
+                del self.image_lock_users[imageName]
+
     async def complete_tasks_START(self, imageName):
         """
-        Update data objects at START with asyncio lock
+        Update data objects at START with the imageName asyncio lock
         and complete all tasks started with START event.
         """
-        async with self.dlock:
+        async with self.lock_image(imageName):
+
+            # START runs in the event loop, and is timed as blocking
+            t0 = time.time()
 
             # Collect metadata at start of integration and
             # load it on the self.metadata dictionary
             self.log.info(f"Collecting Metadata START : {self.name_start} Event")
             self.log.info(f"Creating metadata for: {imageName}")
             self.metadata[imageName] = self.collect(self.keywords_start)
+            # The start of the window for the monitored keywords
+            self.start_time[imageName] = time.time()
 
             # Create the HDR object to be populated with the collected metadata
             # when loading the templates we get a HDR.header object
             self.log.info(f"Creating header object for : {imageName}")
 
-            # Get the self.vendors and self.sensors
-            self.get_vendors_and_sensors()
-            self.log.info(f"Will use vendors: {self.vendor_names}")
-            self.log.info(f"Will use sensors: {self.sensors}")
+            # Get the vendors and sensors for this image
+            vendor_names, sensors = self.get_vendors_and_sensors()
+            self.log.info(f"Will use vendors: {vendor_names}")
+            self.log.info(f"Will use sensors: {sensors}")
             self.HDR[imageName] = hutils.HDRTEMPL(logger=self.log,
                                                   section=self.config.section,
                                                   instrument=self.config.instrument,
                                                   nosensors=self.nosensors,
                                                   segname=self.config.segname,
-                                                  vendor_names=self.vendor_names,
-                                                  sensor_names=self.sensors,
-                                                  write_mode=self.config.write_mode)
+                                                  vendor_names=vendor_names,
+                                                  sensor_names=sensors,
+                                                  write_mode=self.config.write_mode,
+                                                  yaml_emitter=self.config.yaml_emitter,
+                                                  fits_writer=self.config.fits_writer)
             self.HDR[imageName].load_templates()
             # Get the filenames and imageName from the start event payload.
             self.log.info(f"Defining filenames for: {imageName}")
@@ -713,69 +1002,173 @@ class HSWorker(salobj.BaseCsc):
             self.end_evt_timeout_task[imageName] = asyncio.ensure_future(self.end_evt_timeout(imageName,
                                                                                               timeout))
             self.log.info(f"Waiting {timeout} [s] for {self.name_end} Event for: {imageName}")
+            self.add_loop_time(imageName, t0)
 
     async def complete_tasks_END(self, imageName):
         """
-        Update data objects at END with asyncio lock
-        and complete all tasks started with END event
+        Queue imageName into the END pipeline. The queue of the collect
+        stage is not bounded, so END events are never rejected, as the data
+        of the image is already allocated at START. The queues of the later
+        stages are bounded, so a slow stage (i.e. persist or the upload)
+        holds the images back in the collect queue.
+        """
+        if not self.end_workers:
+            self.create_end_pipeline()
+        queue = self.end_queue['collect']
+        if queue.qsize() >= self.config.end_queue_size:
+            self.log.warning(f"END pipeline is behind, {queue.qsize()} images waiting to be collected")
+        await queue.put(imageName)
+
+    def create_end_pipeline(self):
         """
-        async with self.dlock:
+        Create the queues and the worker tasks for the stages of the END
+        pipeline, in the order of END_CONCURRENCY. All of the queues but
+        the one of the collect stage are bounded by end_queue_size
+        """
+        self.end_queue = {}
+        for stage in END_CONCURRENCY:
+            maxsize = 0 if stage == 'collect' else self.config.end_queue_size
+            self.end_queue[stage] = asyncio.Queue(maxsize=maxsize)
+        stages = list(END_CONCURRENCY)
+        for stage, next_stage in zip(stages, stages[1:] + [None]):
+            nworkers = self.config.end_concurrency[stage]
+            self.log.info(f"Starting END pipeline stage: {stage} with {nworkers} worker(s)")
+            for k in range(nworkers):
+                self.end_workers.append(asyncio.ensure_future(self.end_stage_worker(stage, next_stage)))
+
+    def cancel_end_pipeline(self):
+        """
+        Cancel the worker tasks of the END pipeline, and clean the images
+        that are still queued, as their headers will not be written
+        """
+        for task in self.end_workers:
+            task.cancel()
+        self.end_workers = []
+        if not hasattr(self, 'end_queue'):
+            return
+        for stage, queue in self.end_queue.items():
+            while not queue.empty():
+                imageName = queue.get_nowait()
+                queue.task_done()
+                self.log.warning(f"Dropping {imageName} queued at END stage: {stage}")
+                self.clean(imageName)
 
-            # Collect metadata at end of integration
-            self.log.info(f"Collecting Metadata END: {self.name_end} Event")
-            self.log.info(f"Updating metadata for: {imageName}")
-            self.metadata[imageName].update(self.collect(self.keywords_end))
-            # Collect metadata created by the HeaderService
-            self.log.info("Collecting Metadata from HeaderService")
-            # Update header with information from HS
-            self.collect_from_HeaderService(imageName)
-            # We set completed_OK to True, and only change to False later in
-            # case we get an exception
-            self.completed_OK[imageName] = True
+    async def end_stage_worker(self, stage, next_stage):
+        """
+        Worker task for a stage of the END pipeline. It runs
+        self.end_stage_<stage>() for each imageName in the stage queue
+        under the image lock, and passes it to the queue of the next stage
+        """
+        queue = self.end_queue[stage]
+        run_stage = getattr(self, f"end_stage_{stage}")
+        while True:
+            imageName = await queue.get()
+            try:
+                async with self.lock_image(imageName):
+                    # The image data could be gone (i.e. after a clean())
+                    if imageName not in self.completed_OK:
+                        self.log.warning(f"No data for {imageName}, dropped at END stage: {stage}")
+                        continue
+                    try:
+                        await run_stage(imageName)
+                    except Exception as e:
+                        self.log.error(f"Failed END stage: {stage} for: {imageName}")
+                        self.log.exception(str(e))
+                        if next_stage is None:
+                            self.clean(imageName)
+                        else:
+                            self.completed_OK[imageName] = False
+            finally:
+                queue.task_done()
+
+            if next_stage is not None and imageName in self.completed_OK:
+                await self.end_queue[next_stage].put(imageName)
+
+    async def end_stage_collect(self, imageName):
+        """
+        END stage to collect the metadata at the end of integration, from
+        the HeaderService, the camera geometry and playback mode
+        """
+        # This stage runs in the event loop
+        t0 = time.time()
+
+        # Collect metadata at end of integration
+        self.log.info(f"Collecting Metadata END: {self.name_end} Event")
+        self.log.info(f"Updating metadata for: {imageName}")
+        self.metadata[imageName].update(self.collect(self.keywords_end))
+        # Reduce the samples of the monitored keywords over the exposure
+        if self.config.monitor_mode == 'buffer':
+            self.reduce_monitor_metadata(imageName)
+        # Collect metadata created by the HeaderService
+        self.log.info("Collecting Metadata from HeaderService")
+        # Update header with information from HS
+        self.collect_from_HeaderService(imageName)
+        # We set completed_OK to True, and only change to False later in
+        # case we get an exception
+        self.completed_OK[imageName] = True
+
+        # Update header using the information from the camera geometry
+        self.log.info("Updating Header with Camera information")
+        try:
+            self.update_header_geometry(imageName)
+        except Exception as e:
+            # We still want to write a header if we fail to update geometry
+            self.log.warning("Failed call to update_header_geometry")
+            self.log.warning(e)
 
-            # Update header using the information from the camera geometry
-            self.log.info("Updating Header with Camera information")
+        # In case of playback mode, we want to override any metadata
+        # collected in self.metadata[imageName] dictionary. We want to do
+        # this after all collection is done
+        if self.config.playback:
             try:
-                self.update_header_geometry(imageName)
+                # Update the metadata dictionary with json values
+                self.update_header_emuimage(imageName)
             except Exception as e:
-                # We still want to write a header if we fail to update geometry
-                self.log.warning("Failed call to update_header_geometry")
-                self.log.warning(e)
-
-            # In case of playback mode, we want to override any metadata
-            # collected in self.metadata[imageName] dictionary. We want to do
-            # this after all collection is done
-            if self.config.playback:
-                try:
-                    # Update the metadata dictionary with json values
-                    self.update_header_emuimage(imageName)
-                except Exception as e:
-                    self.completed_OK[imageName] = False
-                    self.log.error(e)
-                    self.log.error("Failed call to update_header_emuimage")
-
-            # Update header object with metadata dictionary
-            if self.completed_OK[imageName]:
-                self.update_header(imageName)
-
-            # Write the header only if so far if completed_OK is True, if write
-            # fails it will set self.completed_OK to False
-            if self.completed_OK[imageName]:
-                self.write(imageName)
-
-            # if completed_OK is False we go to FAULT
-            if self.completed_OK[imageName] is False:
-                self.log.warning("Sending the system to FAULT state")
+                self.completed_OK[imageName] = False
+                self.log.error(e)
+                self.log.error("Failed call to update_header_emuimage")
+
+        self.add_loop_time(imageName, t0)
+
+    async def end_stage_render(self, imageName):
+        """END stage to update the header object with the metadata"""
+        t0 = time.time()
+        if self.completed_OK[imageName]:
+            self.update_header(imageName)
+        self.add_loop_time(imageName, t0)
+
+    async def end_stage_persist(self, imageName):
+        """
+        END stage to write the header. Only if so far if completed_OK is
+        True, if write fails it will set self.completed_OK to False
+        """
+        if self.completed_OK[imageName]:
+            await self.write(imageName)
+
+    async def end_stage_publish(self, imageName):
+        """
+        END stage to announce/upload the header, or go to FAULT in case
+        that any of the previous stages failed
+        """
+        # if completed_OK is False we go to FAULT
+        if self.completed_OK[imageName] is False:
+            self.log.warning("Sending the system to FAULT state")
+            async with self.dlock:
                 await self.fault(code=9, report=f"Cannot write header for: {imageName}")
-                self.log.error(f"----- Failed: {imageName} -----")
-            else:
-                # Announce/upload LFO if write_OK is True
-                self.completed_OK[imageName] = True
-                await self.announce(imageName)
-                self.log.info(f"----- Done: {imageName} -----")
+            self.log.error(f"----- Failed: {imageName} -----")
 
-                # Clean up
-                self.clean(imageName)
+            # Clean up, the header will not be written
+            self.record_loop_time(imageName)
+            self.clean(imageName)
+        else:
+            # Announce/upload LFO if write_OK is True
+            self.completed_OK[imageName] = True
+            await self.announce(imageName)
+            self.log.info(f"----- Done: {imageName} -----")
+
+            # Clean up
+            self.record_loop_time(imageName)
+            self.clean(imageName)
 
         if self.summary_state == salobj.State.ENABLED:
             self.log.info("----- Ready for next image -----")
@@ -783,16 +1176,18 @@ class HSWorker(salobj.BaseCsc):
         self.log.info(f"Current state is: {self.summary_state.name}")
 
     def get_vendors_and_sensors(self):
+        """
+        Get the vendor names and sensors for an image. They are returned
+        rather than stored, as several images can be in flight.
+        """
 
         if self.nosensors:
             self.log.info(f"Will not get vendors/ccdnames for {self.config.instrument}")
-            self.vendor_names = []
-            self.sensors = []
-            return
+            return [], []
 
         # Try to get the list of sensor from the Camera Configuration event
         try:
-            self.vendor_names, self.sensors = self.read_camera_vendors()
+            vendor_names, sensors = self.read_camera_vendors()
             self.log.info("Extracted vendors/ccdnames from Camera Configuration")
         except Exception:
             # In the absense of a message from camera to provide the list
@@ -800,10 +1195,10 @@ class HSWorker(salobj.BaseCsc):
             # in hutils
             self.log.warning("Cannot read camera vendor list from event")
             self.log.warning("Will use defaults from config file instead")
-            self.sensors = hutils.build_sensor_list(self.config.instrument)
-            self.vendor_names = self.config.vendor_names
+            sensors = hutils.build_sensor_list(self.config.instrument)
+            vendor_names = self.config.vendor_names
 
-        return
+        return vendor_names, sensors
 
     def update_header_emuimage(self, imageName):
         """
@@ -842,6 +1237,13 @@ class HSWorker(salobj.BaseCsc):
             self.log.warning("Cannot get myData from {}".format(name))
             return
 
+        # The focal plane configuration hardly ever changes, so the lists
+        # are cached keyed by the payload of the event
+        key = (getattr(myData, array_keys), getattr(myData, param))
+        if key in self.camera_conf_cache:
+            self.log.info("Using cached vendors/ccdnames from Camera config event")
+            return self.camera_conf_cache[key]
+
         # 1 We get the keywords List from myData
         payload = getattr(myData, array_keys)
         ccdnames = hutils.split_esc(payload, sep)
@@ -852,6 +1254,9 @@ class HSWorker(salobj.BaseCsc):
         payload = getattr(myData, param)
         vendor_names = hutils.split_esc(payload, sep)
         self.log.info("Successfully read vendors/ccdnames from Camera config event")
+        if len(self.camera_conf_cache) >= 8:
+            self.camera_conf_cache.clear()
+        self.camera_conf_cache[key] = (vendor_names, ccdnames)
         return vendor_names, ccdnames
 
     def update_header_geometry(self, imageName):
@@ -898,18 +1303,31 @@ class HSWorker(salobj.BaseCsc):
     def update_header(self, imageName):
 
         """Update FITSIO header object using the captured metadata"""
+        primary = {}
+        per_sensor = {}
         for keyword, value in self.metadata[imageName].items():
+            # Enum values are numeric until here, and can be numpy integers
+            if keyword in self.enum_keywords and isinstance(value, numbers.Integral):
+                value = self.get_enum_name(keyword, int(value))
             # Check if dictionary with per-sensor values
             if isinstance(value, dict):
-                for sensor in value.keys():
-                    extname = self.HDR[imageName].get_primary_extname(sensor)
-                    self.HDR[imageName].update_record(keyword, value[sensor], extname)
-                    self.log.debug(f"Updating header[{extname}] with {keyword:8s} = {value[sensor]}")
+                per_sensor[keyword] = value
+                self.log.debug(f"Updating header[SENSOR_PRIMARY] with {keyword:8s} = {value}")
             # Otherwise we put it into the PRIMARY
             else:
-                extname = 'PRIMARY'
-                self.log.info(f"Updating header[{extname}] with {keyword:8s} = {value}")
-                self.HDR[imageName].update_record(keyword, value, extname)
+                primary[keyword] = value
+                self.log.debug(f"Updating header[PRIMARY] with {keyword:8s} = {value}")
+        # Apply the whole metadata dictionary in one pass
+        self.log.info(f"Updating header with {len(primary)} PRIMARY keywords "
+                      f"and {len(per_sensor)} per-sensor keywords")
+        self.HDR[imageName].update_many(primary, 'PRIMARY')
+        self.HDR[imageName].update_per_sensor(per_sensor)
+
+    def get_enum_name(self, keyword, value):
+        """Get the name of the numeric enum value for keyword"""
+        device = self.config.telemetry[keyword]['device']
+        array_name = self.config.telemetry[keyword]['array_name']
+        return getattr(self.get_xml_lib(device), array_name)(value).name
 
     def get_imageName(self, myData):
         """
@@ -957,11 +1375,13 @@ class HSWorker(salobj.BaseCsc):
             # i.e. http://S3_ENDPOINT_URL/s3buket_name/key
             url = f"{self.s3conn.meta.client.meta.endpoint_url}/{self.s3bucket.name}/{key}"
             t0 = time.time()
-            with open(self.filename_HDR[imageName], "rb") as f:
-                s3upload = await self.upload_to_s3(f, key, imageName, nt=2)
+            # Upload the bytes in memory from write(), rather than the file
+            fileobj = io.BytesIO(self.header_bytes[imageName])
+            s3upload = await self.upload_to_s3(fileobj, key, imageName, nt=2)
 
             if s3upload is False:
-                await self.fault(code=9, report=f"Failed s3 bucket upload for: {imageName}")
+                async with self.dlock:
+                    await self.fault(code=9, report=f"Failed s3 bucket upload for: {imageName}")
                 self.completed_OK[imageName] = False
                 return
 
@@ -977,9 +1397,9 @@ class HSWorker(salobj.BaseCsc):
         else:
             self.log.error(f"lfa_mode: {self.config.lfa_mode} not supported")
 
-        # Get the md5 for the header file
-        md5value = hutils.md5Checksum(self.filename_HDR[imageName])
-        bytesize = os.path.getsize(self.filename_HDR[imageName])
+        # Get the md5 and size for the header computed by write()
+        md5value = self.header_md5[imageName]
+        bytesize = len(self.header_bytes[imageName])
         self.log.info("Got MD5SUM: {}".format(md5value))
 
         # Now we publish filename and MD5
@@ -1003,6 +1423,8 @@ class HSWorker(salobj.BaseCsc):
         k = 1
         while k <= nt and s3upload is False:
             try:
+                # Start from the beginning in case of a failed attempt
+                fileobj.seek(0)
                 await self.s3bucket.upload(fileobj=fileobj, key=key)
                 s3upload = True
             except Exception as e:
@@ -1011,11 +1433,17 @@ class HSWorker(salobj.BaseCsc):
             k += 1
         return s3upload
 
-    def write(self, imageName):
-        """ Function to call to write the header"""
+    async def write(self, imageName):
+        """
+        Function to call to write the header in the executor. The header
+        bytes and md5 checksum are kept for announce()
+        """
 
         try:
-            self.HDR[imageName].write_header(self.filename_HDR[imageName])
+            data, md5value = await self.run_blocking(imageName, self.HDR[imageName].write_header,
+                                                     self.filename_HDR[imageName])
+            self.header_bytes[imageName] = data
+            self.header_md5[imageName] = md5value
             self.log.info(f"Wrote header to filesystem: {self.filename_HDR[imageName]}")
         except Exception as e:
             self.log.error(f"Cannot write header to filesystem {self.filename_HDR[imageName]}")
@@ -1024,14 +1452,21 @@ class HSWorker(salobj.BaseCsc):
             self.completed_OK[imageName] = False
 
     def clean(self, imageName):
-        """ Clean up imageName data structures"""
+        """
+        Clean up imageName data structures. As images overlap, the data
+        can be already gone (i.e. cancel_timeout_tasks())
+        """
         self.log.info(f"Cleaning data for: {imageName}")
-        del self.end_evt_timeout_task[imageName]
-        del self.metadata[imageName]
-        del self.HDR[imageName]
-        del self.filename_HDR[imageName]
-        del self.filename_FITS[imageName]
-        del self.completed_OK[imageName]
+        self.end_evt_timeout_task.pop(imageName, None)
+        self.metadata.pop(imageName, None)
+        self.HDR.pop(imageName, None)
+        self.filename_HDR.pop(imageName, None)
+        self.filename_FITS.pop(imageName, None)
+        self.completed_OK.pop(imageName, None)
+        self.loop_time.pop(imageName, None)
+        self.header_bytes.pop(imageName, None)
+        self.header_md5.pop(imageName, None)
+        self.start_time.pop(imageName, None)
 
     def create_dicts(self):
         """
@@ -1045,6 +1480,44 @@ class HSWorker(salobj.BaseCsc):
         self.filename_FITS = {}
         self.filename_HDR = {}
         self.completed_OK = {}
+        self.image_lock = {}
+        self.image_lock_users = {}
+        self.loop_time = {}
+        self.header_bytes = {}
+        self.header_md5 = {}
+        self.start_time = {}
+
+    def compile_collection_plans(self):
+        """
+        Compile the collection plans for the keywords collected at
+        start/end, by the other collection events and by the monitors
+        """
+        self.collection_plans = {}
+        keyword_lists = [self.keywords_start, self.keywords_end]
+        keyword_lists.extend(self.collection_events_keys.values())
+        keyword_lists.extend(self.monitor_event_channels_keys.values())
+        for keys in keyword_lists:
+            self.get_collection_plan(keys)
+        self.log.info(f"Compiled {len(self.collection_plans)} collection plans")
+
+    def get_collection_plan(self, keys):
+        """
+        Get the collection plan for a list of keywords, compiled on the
+        first call. The plan is the tuple (names, extractors) with the
+        unique channel names to read and a list of (keyword, name,
+        extractor) in the order of keys
+        """
+        plan_key = tuple(keys)
+        if plan_key not in self.collection_plans:
+            names = []
+            extractors = []
+            for keyword in keys:
+                name = get_channel_name(self.config.telemetry[keyword])
+                if name not in names:
+                    names.append(name)
+                extractors.append((keyword, name, self.build_extractor(keyword)))
+            self.collection_plans[plan_key] = (names, extractors)
+        return self.collection_plans[plan_key]
 
     def collect(self, keys):
         """ Collect meta-data from the telemetry-connected channels
@@ -1053,32 +1526,137 @@ class HSWorker(salobj.BaseCsc):
         # Define myData and metadata dictionaries
         # myData: holds the payload from Telem/Events
         # metadata: holds the metadata to be inserted into the Header object
+        if self.config.collect_mode == 'push':
+            return self.collect_latest(keys)
+
+        names, extractors = self.get_collection_plan(keys)
         myData = {}
         metadata = {}
-        for keyword in keys:
-            name = get_channel_name(self.config.telemetry[keyword])
-            # Access data payload only once
-            if name not in myData:
-                myData[name] = self.Remote_get[name]()
-                self.log.info(f"Checking expiration for {name}")
-                if self.check_telemetry_expired(myData[name]):
-                    self.log.warning(f"Expired telemetry for {name} -- will ignore")
-                    myData[name] = None
+        # Access data payload only once per channel
+        for name in names:
+            myData[name] = self.Remote_get[name]()
+            self.log.info(f"Checking expiration for {name}")
+            if self.check_telemetry_expired(myData[name]):
+                self.log.warning(f"Expired telemetry for {name} -- will ignore")
+                myData[name] = None
+
+        for keyword, name, extractor in extractors:
             # Only update metadata if myData is defined (not None)
             if myData[name] is None:
                 self.log.warning(f"Cannot get keyword: {keyword} from topic: {name}")
-            else:
-                try:
-                    metadata[keyword] = self.extract_from_myData(keyword, myData[name])
-                    self.log.debug(f"Extracted {keyword}: {metadata[keyword]}")
-                    # Scale by `scale` if it was defined
-                    if 'scale' in self.config.telemetry[keyword]:
-                        metadata[keyword] = metadata[keyword]*self.config.telemetry[keyword]['scale']
-                        self.log.info(f"Scaled key: {keyword} by: {self.config.telemetry[keyword]['scale']}")
-                except Exception as err:
-                    self.log.error(f"Error while extracting keyword: {keyword} from topic: {name}")
-                    self.log.error(f"{err.__class__.__name__}: {err}")
+                continue
+            try:
+                metadata[keyword] = extractor(myData[name])
+                self.log.debug(f"Extracted {keyword}: {metadata[keyword]}")
+            except Exception as err:
+                self.log.error(f"Error while extracting keyword: {keyword} from topic: {name}")
+                self.log.error(f"{err.__class__.__name__}: {err}")
+
+        return metadata
+
+    def define_latest_callbacks(self):
+        """
+        Set the callbacks that keep the table of latest values for the
+        telemetry channels in push collect_mode. The callbacks already
+        defined for a topic (i.e. START/END) are chained after the update
+        """
+        self.latest_values = {}
+        names, extractors = self.get_collection_plan(list(self.config.telemetry))
+        self.channel_extractors = {name: [] for name in names}
+        for keyword, name, extractor in extractors:
+            self.channel_extractors[name].append((keyword, extractor))
+
+        for name in names:
+            c = self.channels[name]
+            devname = get_channel_devname(c)
+            prefix = 'evt' if c['Stype'] == 'Event' else 'tel'
+            topic = getattr(self.Remote[devname], f"{prefix}_{c['topic']}")
+            topic.callback = self.callback_latest_builder(name, topic.callback)
+            self.log.info(f"Defining LATEST callback for: {devname} {prefix}_{c['topic']}")
+
+    def callback_latest_builder(self, name, callback=None):
+        """Function builder for the latest value callbacks"""
+        def latest_value_callback(myData):
+            """
+            Update the latest values for the channel with the payload, and
+            call the callback previously defined for the topic, if any
+            """
+            self.update_latest_values(name, myData)
+            if callback is not None:
+                return callback(myData)
+
+        return latest_value_callback
+
+    def update_latest_values(self, name, myData):
+        """
+        Extract all the keywords of channel name from myData and store
+        them in the table of latest values as the tuple:
+        (values, errors, received, expiresAt). Extraction errors are kept
+        to be reported by collect()
+        """
+        if myData is None:
+            self.latest_values[name] = None
+            return
+        values = {}
+        errors = {}
+        for keyword, extractor in self.channel_extractors[name]:
+            try:
+                values[keyword] = extractor(myData)
+            except Exception as err:
+                errors[keyword] = err
+        expiresAt = getattr(myData, 'expiresAt', None)
+        self.latest_values[name] = (values, errors, time.time(), expiresAt)
+
+    def seed_latest_values(self):
+        """
+        Seed the table of latest values with one read of Remote_get for
+        the channels of the Remotes that are ready, as the callbacks only
+        see the data published after the start
+        """
+        seeded = 0
+        for name in self.channel_extractors:
+            if not self.Remote_ready[get_channel_devname(self.channels[name])]:
+                continue
+            if self.latest_values.get(name) is None:
+                self.update_latest_values(name, self.Remote_get[name]())
+            if self.latest_values[name] is not None:
+                seeded += 1
+        self.log.info(f"Seeded latest values for {seeded}/{len(self.channel_extractors)} channels")
+
+    def collect_latest(self, keys):
+        """
+        Collect meta-data from the table of latest values kept by the
+        callbacks in push collect_mode. Channels without data pushed yet
+        are read with Remote_get
+        """
+        names, extractors = self.get_collection_plan(keys)
+        latest = {}
+        for name in names:
+            if self.latest_values.get(name) is None:
+                self.log.info(f"No latest values for {name} -- will get them from Remote")
+                self.update_latest_values(name, self.Remote_get[name]())
+            latest[name] = self.latest_values[name]
+            if latest[name] is None:
+                continue
+            expiresAt = latest[name][3]
+            if expiresAt is not None and time.time() > expiresAt:
+                self.log.warning(f"Expired telemetry for {name} -- will ignore")
+                latest[name] = None
 
+        metadata = {}
+        for keyword, name, extractor in extractors:
+            if latest[name] is None:
+                self.log.warning(f"Cannot get keyword: {keyword} from topic: {name}")
+                continue
+            values, errors, received, expiresAt = latest[name]
+            if keyword in errors:
+                err = errors[keyword]
+                self.log.error(f"Error while extracting keyword: {keyword} from topic: {name}")
+                self.log.error(f"{err.__class__.__name__}: {err}")
+                continue
+            # Copy the per-sensor dictionaries, as the table is shared
+            value = values[keyword]
+            metadata[keyword] = dict(value) if isinstance(value, dict) else value
         return metadata
 
     def check_telemetry_expired(self, myData):
@@ -1094,55 +1672,90 @@ class HSWorker(salobj.BaseCsc):
         return has_expired
 
     def extract_from_myData(self, keyword, myData, sep=":"):
+        """Extract the value of keyword from the payload myData"""
+        return self.build_extractor(keyword, sep)(myData)
 
-        param = self.config.telemetry[keyword]['value']
-        payload = getattr(myData, param)
+    def build_extractor(self, keyword, sep=":"):
+        """
+        Build the function that extracts the value of keyword from the
+        payload myData of its channel. The array type of keyword is
+        resolved here, and the `scale` (if defined) is folded in
+        """
+        telem = self.config.telemetry[keyword]
+        param = telem['value']
+        array = telem.get('array')
 
         # Case 1 -- we want just one value per key (scalar)
-        if 'array' not in self.config.telemetry[keyword]:
+        if array is None:
             self.log.debug(f"{keyword} is a scalar")
-            extracted_payload = payload
+
+            def extractor(myData):
+                return getattr(myData, param)
         # Case 2 -- array of values per sensor
-        elif self.config.telemetry[keyword]['array'] == 'CCD_array':
+        elif array == 'CCD_array':
             self.log.debug(f"{keyword} is an array: CCD_array")
-            ccdnames = self.get_array_keys(keyword, myData, sep)
-            # When ATCamera sends (via SAL/DDS) and array with just one element
-            # this is actually not send as a list/array, but as scalar instead.
-            # Therefore, if expecting and list/array and length is (1), then we
-            # need to recast SAL payload as a list.
-            if len(ccdnames) == 1 and not isinstance(payload, list):
-                payload = [payload]
-                self.log.warning(f"Recasting payload to a list for {keyword}:{payload}")
-            extracted_payload = dict(zip(ccdnames, payload))
-        elif self.config.telemetry[keyword]['array'] == 'CCD_array_str':
+
+            def extractor(myData):
+                payload = getattr(myData, param)
+                ccdnames = self.get_array_keys(keyword, myData, sep)
+                # When ATCamera sends (via SAL/DDS) and array with just one
+                # element this is actually not send as a list/array, but as
+                # scalar instead. Therefore, if expecting and list/array and
+                # length is (1), then we need to recast SAL payload as a list.
+                if len(ccdnames) == 1 and not isinstance(payload, list):
+                    payload = [payload]
+                    self.log.warning(f"Recasting payload to a list for {keyword}:{payload}")
+                return dict(zip(ccdnames, payload))
+        elif array == 'CCD_array_str':
             self.log.debug(f"{keyword} is string array: CCD_array_str")
-            ccdnames = self.get_array_keys(keyword, myData, sep)
-            # Split the payload into an array of strings
-            extracted_payload = dict(zip(ccdnames, hutils.split_esc(payload, sep)))
-        elif self.config.telemetry[keyword]['array'] == 'indexed_array':
+
+            def extractor(myData):
+                ccdnames = self.get_array_keys(keyword, myData, sep)
+                # Split the payload into an array of strings
+                return dict(zip(ccdnames, hutils.split_esc(getattr(myData, param), sep)))
+        elif array == 'indexed_array':
             self.log.debug(f"{keyword} is an array: indexed_array")
-            index = self.config.telemetry[keyword]['array_index']
-            # Extract the requested index
-            extracted_payload = payload[index]
-        elif self.config.telemetry[keyword]['array'] == 'keyed_array':
+            index = telem['array_index']
+
+            def extractor(myData):
+                # Extract the requested index
+                return getattr(myData, param)[index]
+        elif array == 'keyed_array':
             self.log.debug(f"{keyword} is an array: keyed_array")
-            keywords = self.get_array_keys(keyword, myData, sep)
-            key = self.config.telemetry[keyword]['array_keyname']
-            # Extract only the requested key from the dictionary
-            extracted_payload = dict(zip(keywords, hutils.split_esc(payload, sep)))[key]
-        # Case 3 -- enumeration using xml libraries
-        elif self.config.telemetry[keyword]['array'] == 'enum':
-            device = self.config.telemetry[keyword]['device']
-            array_name = self.config.telemetry[keyword]['array_name']
-            extracted_payload = getattr(self.xml_lib[device], array_name)(payload).name
-        # If some kind of array take first element
-        elif hasattr(payload, "__len__") and not isinstance(payload, str):
-            self.log.debug(f"{keyword} is just an array")
-            extracted_payload = payload[0]
+            key = telem['array_keyname']
+
+            def extractor(myData):
+                keywords = self.get_array_keys(keyword, myData, sep)
+                # Extract only the requested key from the dictionary
+                return dict(zip(keywords, hutils.split_esc(getattr(myData, param), sep)))[key]
+        # Case 3 -- enumeration using xml libraries, the value is kept
+        # numeric until the header is updated (see get_enum_name)
+        elif array == 'enum':
+            device = telem['device']
+            array_name = telem['array_name']
+
+            def extractor(myData):
+                return getattr(self.get_xml_lib(device), array_name)(getattr(myData, param)).value
         else:
-            self.log.debug(f"Undefined type for {keyword}")
-            extracted_payload = None
-        return extracted_payload
+            def extractor(myData):
+                payload = getattr(myData, param)
+                # If some kind of array take first element
+                if hasattr(payload, "__len__") and not isinstance(payload, str):
+                    self.log.debug(f"{keyword} is just an array")
+                    return payload[0]
+                self.log.debug(f"Undefined type for {keyword}")
+                return None
+
+        # Scale by `scale` if it was defined
+        if 'scale' in telem:
+            scale = telem['scale']
+            extract_value = extractor
+            self.log.info(f"Will scale key: {keyword} by: {scale}")
+
+            def extractor(myData):
+                return extract_value(myData)*scale
+
+        return extractor
 
     def get_array_keys(self, keyword, myData, sep=":"):
         """
@@ -1174,27 +1787,16 @@ class HSWorker(salobj.BaseCsc):
 
         # Reformat and calculate dates based on different timeStamps
         # NOTE: For now the timestamp are coming in UTC from Camera and are
-        # transformed to TAI by the function hscalc.get_date()
+        # converted by hsdate.get_isot_mjd(), which matches astropy.time
         # Store the creation date of the header file -- i.e. now!!
-        DATE = hscalc.get_date(time.time())
-        metadata['DATE'] = DATE.isot
-        # Need to force MJD dates to floats for yaml header
-        metadata['MJD'] = float(DATE.mjd)
-
-        if 'DATE-OBS' in metadata:
-            DATE_OBS = hscalc.get_date(metadata['DATE-OBS'])
-            metadata['DATE-OBS'] = DATE_OBS.isot
-            metadata['MJD-OBS'] = float(DATE_OBS.mjd)
-
-        if 'DATE-BEG' in metadata:
-            DATE_BEG = hscalc.get_date(metadata['DATE-BEG'])
-            metadata['DATE-BEG'] = DATE_BEG.isot
-            metadata['MJD-BEG'] = float(DATE_BEG.mjd)
-
-        if 'DATE-END' in metadata:
-            DATE_END = hscalc.get_date(metadata['DATE-END'])
-            metadata['DATE-END'] = DATE_END.isot
-            metadata['MJD-END'] = float(DATE_END.mjd)
+        # MJD dates are returned as floats for the yaml header
+        metadata['DATE'], metadata['MJD'] = hsdate.get_isot_mjd(time.time())
+
+        for key, mjdkey in (('DATE-OBS', 'MJD-OBS'),
+                            ('DATE-BEG', 'MJD-BEG'),
+                            ('DATE-END', 'MJD-END')):
+            if key in metadata:
+                metadata[key], metadata[mjdkey] = hsdate.get_isot_mjd(metadata[key])
 
         metadata['FILENAME'] = self.filename_FITS[imageName]
         if self.tstand:
@@ -1203,284 +1805,157 @@ class HSWorker(salobj.BaseCsc):
         # Update the imageName metadata with new dict
         self.metadata[imageName].update(metadata)
 
-    def update_monitor_metadata(self, imageName, keywords):
+    def create_monitor_buffers(self):
+        """
+        Create the ring buffers for the samples of the monitored keywords
+        with a numeric rule in monitor_mode: 'buffer'. Enum keywords, and
+        the keywords with the 'latest' rule, only keep the last value
+        """
+        self.monitor_rules = {}
+        self.monitor_buffers = {}
+        self.monitor_last = {}
+        for keywords in self.monitor_event_channels_keys.values():
+            for keyword in keywords:
+                rule = self.config.telemetry[keyword].get('rule', 'latest')
+                if rule not in MONITOR_REDUCTIONS:
+                    msg = f"rule: {rule} not supported"
+                    self.log.error(msg)
+                    raise ValueError(msg)
+                if rule != 'latest' and keyword in self.enum_keywords:
+                    self.log.warning(f"rule: {rule} not supported for enum keyword: {keyword} "
+                                     "-- will use the last value")
+                    rule = 'latest'
+                self.monitor_rules[keyword] = rule
+                if rule != 'latest':
+                    self.monitor_buffers[keyword] = hutils.RingBuffer(self.config.monitor_buffer_size)
+        self.log.info(f"Created ring buffers for: {list(self.monitor_buffers.keys())}")
+
+    def record_monitor_samples(self, keywords):
+        """
+        Collect the monitored keywords once and record the samples. A
+        keyword with a non-numeric sample loses its ring buffer, and falls
+        back to the last value
+        """
+        metadata = self.collect(keywords)
+        timestamp = time.time()
+        for keyword in keywords:
+            value = metadata.get(keyword)
+            if value is None:
+                self.log.warning(f"Cannot record monitored keyword: {keyword}")
+                continue
+            self.monitor_last[keyword] = (timestamp, value)
+            if keyword not in self.monitor_buffers:
+                continue
+            if not is_numeric(value):
+                self.log.warning(f"Non-numeric value: {value} for monitored keyword: {keyword} "
+                                 "-- will use the last value")
+                del self.monitor_buffers[keyword]
+                continue
+            self.monitor_buffers[keyword].append(timestamp, value)
+
+    def reduce_monitor_metadata(self, imageName):
+        """
+        Update the monitored keywords of imageName with the reduction of
+        the value at START and the samples recorded until now, or with the
+        last value recorded since START for the keywords without a ring
+        buffer
+        """
+        t0 = self.start_time[imageName]
+        t1 = time.time()
+        metadata = self.metadata[imageName]
+        for keyword, rule in self.monitor_rules.items():
+            if keyword not in self.monitor_buffers:
+                last = self.monitor_last.get(keyword)
+                if last is not None and t0 <= last[0] <= t1:
+                    self.log.info(f"Monitor updated {keyword} for {imageName} with last value --> {last[1]}")
+                    metadata[keyword] = last[1]
+                continue
+            values, complete = self.monitor_buffers[keyword].window(t0, t1)
+            if not complete:
+                self.log.warning(f"Ring buffer for {keyword} lost samples for: {imageName}, "
+                                 "consider a larger monitor_buffer_size")
+            # The value at START is None for a channel not seen yet
+            if is_numeric(metadata.get(keyword)):
+                values = numpy.concatenate(([metadata[keyword]], values))
+            if len(values) == 0:
+                continue
+            updated_value = MONITOR_REDUCTIONS[rule](values).item()
+            self.log.info(f"Monitor updated {keyword} for {imageName} with {rule} of "
+                          f"{len(values)} values --> {updated_value}")
+            metadata[keyword] = updated_value
+
+    def update_monitor_metadata(self, imageNames, keywords):
+        """
+        Collect the monitored keywords once, and apply the rule of each
+        keyword to the metadata of all of the in-flight imageNames. Enum
+        values are numeric, so the rules apply to them directly
+        """
 
         # Collect new metadata for keywords
         metadata = self.collect(keywords)
         # Apply rule for each keyword
         for keyword in keywords:
 
+            if keyword not in metadata:
+                self.log.warning(f"Cannot update monitored keyword: {keyword}")
+                continue
             latest_value = metadata[keyword]
-            current_value = self.metadata[imageName][keyword]
-
-            if 'array' not in self.config.telemetry[keyword]:
-                self.log.info(f"keyword:{keyword} not an array")
-                isenum = False
-                pass
-            # Check if keyword is enum type and transform back to numerator
-            elif self.config.telemetry[keyword]['array'] == 'enum':
-                isenum = True
-                latest_value = metadata[keyword]
-                current_value = self.metadata[imageName][keyword]
-                device = self.config.telemetry[keyword]['device']
-                array_name = self.config.telemetry[keyword]['array_name']
-                device_lib = getattr(self.xml_lib[device], array_name)
-                latest_value = getattr(device_lib, latest_value).numerator
-                current_value = getattr(device_lib, current_value).numerator
-            else:
-                msg = f"array: {self.config.telemetry[keyword]['array']} not supported for monitor"
+
+            array = self.config.telemetry[keyword].get('array')
+            if array is not None and array != 'enum':
+                msg = f"array: {array} not supported for monitor"
                 self.log.error(msg)
                 raise ValueError(msg)
 
             # Make sure that we have a rule defined to extract for the keyword
             if 'rule' not in self.config.telemetry[keyword]:
                 self.log.warning(f"rule not defined for {keyword} -- will use current value")
-                updated_value = latest_value
-            elif self.config.telemetry[keyword]['rule'] == 'latest':
-                updated_value = latest_value
-            elif self.config.telemetry[keyword]['rule'] == 'max':
-                updated_value = max(current_value, latest_value)
-            elif self.config.telemetry[keyword]['rule'] == 'min':
-                updated_value = min(current_value, latest_value)
+                rule = MONITOR_RULES['latest']
+            elif self.config.telemetry[keyword]['rule'] in MONITOR_RULES:
+                rule = MONITOR_RULES[self.config.telemetry[keyword]['rule']]
             else:
                 msg = f"rule: {self.config.telemetry[keyword]['rule']} not supported"
                 self.log.error(msg)
                 raise ValueError(msg)
 
-            # Translate to enun name string
-            if isenum:
-                updated_value = device_lib(updated_value).name
-                current_value = device_lib(current_value).name
-
-            self.metadata[imageName][keyword] = updated_value
-            self.log.info(f"Monitor updated {keyword} value from {current_value} --> {updated_value}")
+            # Apply the rule to all images at once, for images without a
+            # current value we use the latest
+            current_values = [self.metadata[imageName].get(keyword, latest_value) for imageName in imageNames]
+            updated_values = [rule(current_value, latest_value) for current_value in current_values]
+            for imageName, current_value, updated_value in zip(imageNames, current_values, updated_values):
+                self.metadata[imageName][keyword] = updated_value
+                self.log.info(f"Monitor updated {keyword} value for {imageName} "
+                              f"from {current_value} --> {updated_value}")
 
         return
 
 # --- end of class ----
 
 
-def get_channel_name(c):
-    """ Standard formatting for the name of a channel across modules"""
-    # Assume index=0 if not defined
-    if 'device_index' not in c:
-        c['device_index'] = 0
-    return '{}_{}_{}'.format(c['device'], c['device_index'], c['topic'])
-
-
-def get_channel_device(c):
-    """ Standard formatting for the device name of a channel across modules"""
-    if 'device_index' not in c:
-        c['device_index'] = 0
-    return c['device']
-
-
-def get_channel_devname(c):
-    """ Standard formatting for the 'devname' of a channel across modules"""
-    if 'device_index' not in c:
-        c['device_index'] = 0
-    return "{}_{}".format(c['device'], c['device_index'])
-
-
-def get_channel_topic(c):
-    """ Standard formatting for the topic of a channel across modules"""
-    return c['topic']
-
-
-def collect_device_topics(c, device_topics):
-    """
-    Collect and update/augment topics for each device in the input
-    device_topics dictionary
-    """
-    devname = get_channel_devname(c)
-    topic = get_channel_topic(c)
-    device_topics.setdefault(devname, [])
-    if topic not in device_topics[devname]:
-        device_topics[devname].append(topic)
-    return device_topics
-
-
-def get_enum_cscs(telem):
-    """
-    Get only the enumerated devices described
-    in the telemetry section of the config
-    """
-    enum_cscs = []
-    for key in telem:
-        if 'array' in telem[key] and telem[key]['array'] == 'enum':
-            if telem[key]['device'] not in enum_cscs:
-                enum_cscs.append(telem[key]['device'])
-    return enum_cscs
-
-
-def get_collection_events(config):
-    """
-    Get the names of the collection event, where we want to collect telemetry
-    """
-
-    telem = config.telemetry
-    collection_events = {}
-    collection_events_names = []
-    collection_events_keys = {}
-    for key in telem:
-        # Extract the string or dictionary that for 'collect_after_event'
-        collect_after_event = telem[key]['collect_after_event']
-        # Case 1: it is one of the fixed collection events, so we get the info
-        # from the config section
-        if isinstance(collect_after_event, str) and collect_after_event in FIXED_COLLECTION_EVENTS:
-            collect_dict = getattr(config, collect_after_event)
-        # Case 2: it is a custom collection event, defined as a dictionary in
-        # the telemetry section of the config.
-        elif isinstance(collect_after_event, dict):
-            collect_dict = telem[key]['collect_after_event']
-        else:
-            msg = f"Wrong definition 'collect_after_event' for keyword:{key}"
-            raise ValueError(msg)
-
-        # Get the device and topic for collection event
-        device = collect_dict['device']
-        topic = collect_dict['topic']
-        name = get_channel_name(collect_dict)
-        # Append channel (i.e.: event name) if not in the list already
-        if name not in collection_events_names:
-            collection_events_names.append(name)
-            collection_events[name] = {'device': device, 'topic': topic}
-            collection_events_keys[name] = [key]
-        else:
-            collection_events_keys[name].append(key)
-
-    return collection_events, collection_events_names, collection_events_keys
+def is_numeric(value):
+    """Check if value is a real number that can go in a RingBuffer"""
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
 
 
-def get_monitor_channels(telem):
+@functools.lru_cache(maxsize=None)
+def get_fqdn():
     """
-    Get only events that we need to monitor
-    in the telemetry section of the config
+    The fully qualified domain name of the host, resolved once. None if
+    the lookup failed, which is cached too
     """
-
-    # The allowed rules for monitored telemetry
-    valid_rules = frozenset(["min", "max", "latest"])
-
-    monitor_event_channels_names = []
-    monitor_event_channels_keys = {}
-    monitor_event_channels = {}
-    for key in telem:
-        if 'monitor' in telem[key] and telem[key]['monitor'] is True:
-            # Extract rule and set to default value if not defined
-            if 'rule' not in telem[key]:
-                rule = 'latest'
-            else:
-                rule = telem[key]['rule']
-
-            if rule not in valid_rules:
-                msg = f"Wrong rule definition:{rule} for keyword:{key}"
-                raise ValueError(msg)
-
-            channel_name = get_channel_name(telem[key])
-            if channel_name not in monitor_event_channels_names:
-                monitor_event_channels_names.append(channel_name)
-                monitor_event_channels[channel_name] = telem[key]
-                monitor_event_channels_keys[channel_name] = [key]
-            else:
-                monitor_event_channels_keys[channel_name].append(key)
-    return monitor_event_channels, monitor_event_channels_names, monitor_event_channels_keys
+    try:
+        return socket.getfqdn()
+    except OSError:
+        return None
 
 
-def extract_telemetry_channels(telem, start_collection_event=None,
-                               end_collection_event=None,
-                               imageParam_event=None,
-                               cameraConf_event=None):
+@functools.lru_cache(maxsize=None)
+def get_host_ip():
     """
-    Get the unique telemetry channels from telemetry dictionary to
-    define the topics that we need to subscribe to
+    The IP address of the host, resolved once. None if the lookup failed,
+    which is cached too
     """
-    channels = {}
-    device_topics = {}
-    for key in telem:
-        # Extract the string or dictionary that for 'collect_after_event'
-        collect_after_event = telem[key]['collect_after_event']
-        # Case 1: it is one of the fixed collection events
-        print(f"{key} -- collect_after_event: {collect_after_event}")
-        if isinstance(collect_after_event, str) and collect_after_event in FIXED_COLLECTION_EVENTS:
-            collect_dict = None
-
-        # Case 2: it is a custom collection event, defined as a dictionary in
-        # the telemetry section of the config.
-        elif isinstance(collect_after_event, dict):
-            collect_dict = telem[key]['collect_after_event']
-        else:
-            msg = f"Wrong definition 'collect_after_event' for keyword:{key}"
-            raise ValueError(msg)
-
-        # Add array qualifier -- REVISE or replace by array
-        if 'type' not in telem[key]:
-            telem[key]['type'] = 'scalar'
-        # Add default index=0 if undefined
-        if 'device_index' not in telem[key]:
-            telem[key]['device_index'] = 0
-        name = get_channel_name(telem[key])
-        # Make sure we don't create extra channels
-        if name not in channels.keys():
-            channels[name] = telem[key]
-        # Store the topics for the device
-        if collect_dict is not None:
-            device_topics = collect_device_topics(collect_dict, device_topics)
-        device_topics = collect_device_topics(telem[key], device_topics)
-
-    # We also need to make sure that we subscribe to the start/end
-    # collection Events in case these were not contained by the
-    if start_collection_event:
-        # Shortcut to variable c, note that when we update c
-        # we also update the end_collection_event dictionary
-        c = start_collection_event
-        # Assume index=0 if not defined
-        if 'device_index' not in c:
-            c['device_index'] = 0
-        name = get_channel_name(c)
-        if name not in channels.keys():
-            c['Stype'] = 'Event'
-            channels[name] = c
-        # Store the topics for the device
-        device_topics = collect_device_topics(c, device_topics)
-
-    if end_collection_event:
-        # Shortcut to variable c, note that when we update c
-        # we also update the end_collection_event dictionary
-        c = end_collection_event
-        # Assume index=0 if not defined
-        if 'device_index' not in c:
-            c['device_index'] = 0
-        name = get_channel_name(c)
-        if name not in list(channels.keys()):
-            c['Stype'] = 'Event'
-            channels[name] = c
-        # Store the topics for the device
-        device_topics = collect_device_topics(c, device_topics)
-
-    # The imageParam event
-    if imageParam_event:
-        c = imageParam_event
-        # Assume index=0 if not defined
-        if 'device_index' not in c:
-            c['device_index'] = 0
-        name = get_channel_name(c)
-        if name not in channels.keys():
-            c['Stype'] = 'Event'
-            channels[name] = c
-        # Store the topics for the device
-        device_topics = collect_device_topics(c, device_topics)
-
-    # The cameraConf_event event
-    if cameraConf_event:
-        c = cameraConf_event
-        # Assume index=0 if not defined
-        if 'device_index' not in c:
-            c['device_index'] = 0
-        name = get_channel_name(c)
-        if name not in channels.keys():
-            c['Stype'] = 'Event'
-            channels[name] = c
-        # Store the topics for the device
-        device_topics = collect_device_topics(c, device_topics)
-
-    return channels, device_topics
+    try:
+        return socket.gethostbyname(socket.gethostname())
+    except OSError:
+        return None
@@ -1,8 +1,10 @@
+import ast
 import string
 import re
 
 # Regular expression to catch ${variable} format in string
 REGEX = r"\${(.*?)\}"
+VAR_PATTERN = re.compile(REGEX, re.MULTILINE | re.DOTALL)
 
 
 def get_var_names(d):
@@ -19,7 +21,7 @@ def get_var_names(d):
             matches = get_var_names(val)
             all_matches.extend(x for x in matches if x not in all_matches)
         else:
-            matches = re.findall(REGEX, str(val), re.MULTILINE | re.DOTALL)
+            matches = VAR_PATTERN.findall(str(val))
             all_matches.extend(x for x in matches if x not in all_matches)
     return all_matches
 
@@ -65,16 +67,21 @@ def update_var_value(val, var_dict):
     """
 
     s = str(val)
-    matches = re.findall(REGEX, s, re.MULTILINE | re.DOTALL)
-    if len(list(matches)) > 0:
+    if '${' not in s:
+        return val
+    matches = VAR_PATTERN.findall(s)
+    if len(matches) > 0:
         # Build the dictionary with kwargs
         kw = {}
         for match in matches:
+            if match not in var_dict:
+                raise ValueError(f"Undefined variable: ${{{match}}} in: {s}")
             kw[match] = var_dict[match]
         template = string.Template(s)
         newval = template.safe_substitute(**kw)
+        # Convert to python literals (i.e.: numbers), never evaluate code
         try:
-            newval = eval(newval)
+            newval = ast.literal_eval(newval)
         except Exception:
             pass
     else:
@@ -82,14 +89,24 @@ def update_var_value(val, var_dict):
     return newval
 
 
+def resolve_variables(d, var_dict):
+    """
+    Replace ${variable} in all values of the dictionary (recursively)
+    with the values in var_dict, in a single pass
+    """
+    for key, val in d.items():
+        if isinstance(val, dict):
+            resolve_variables(val, var_dict)
+        else:
+            d[key] = update_var_value(val, var_dict)
+    return d
+
+
 def replace_variables_in_dict(d):
     """
     Replace all variables in the dictionary with the format ${variable} by the
-    value defined as variable:value in the same dictionary itself. The
-    functions need to be called one at a time as these are recursive functions.
-    Probably there is a simpler way to do this.... :(
+    value defined as variable:value in the same dictionary itself. The values
+    of the variables are taken from the dictionary before any replacement,
+    and a ValueError is raised for undefined variables.
     """
-    var_names = get_var_names(d)
-    var_dict = get_var_dict(d, var_names)
-    new_dict = update_var_dict(d, var_dict)
-    return new_dict
+    return resolve_variables(d, dict(d))
@@ -29,8 +29,11 @@ import yaml
 import logging
 from logging.handlers import RotatingFileHandler
 import hashlib
+import functools
 import itertools
 import copy
+import numbers
+import numpy
 from .camera_coords import CCDInfo
 from . import camera_coords
 import datetime
@@ -44,6 +47,58 @@ try:
 except KeyError:
     HEADERSERVICE_DIR = __file__.split('python')[0]
 
+# Process-wide cache of parsed header templates keyed by the
+# (path, mtime, size) of the template file, see get_head_template()
+TEMPLATE_CACHE = {}
+
+# Process-wide cache of the rendered geometry records per sensor, keyed by
+# the templates and the geometry fingerprint, see HDRTEMPL.load_geometry()
+GEOMETRY_CACHE = {}
+
+# Process-wide cache of the pre-serialized records of each template with
+# the shared (geometry) records on top, see HDRFragments
+FRAGMENT_CACHE = {}
+
+# Process-wide cache of the HDRLIST, segment names, vendors and CCDInfo
+# objects keyed by the camera configuration, see HDRTEMPL.load_layout()
+LAYOUT_CACHE = {}
+
+# The values of the template cards parsed by parse_template_card(), the
+# others are converted by fitsio
+TEMPLATE_INT = re.compile(r'[+-]?(?:0|[1-9][0-9]{0,17})\Z')
+TEMPLATE_FLOAT = re.compile(r'[+-]?(?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?\Z')
+# The cfitsio keyword class of each keyword name, see parse_template_card()
+KEYWORD_CLASS = {}
+# The record 'class' for comment and blank cards (see fitsio.header)
+TYP_COMM_KEY = 130
+TYP_USER_KEY = 150
+
+# Settings of yaml.dump() that emit_header_yaml() reproduces
+YAML_WIDTH = 80
+YAML_INDICATORS = '#,[]{}&*!|>\'"%@`'
+YAML_STR_TAG = 'tag:yaml.org,2002:str'
+YAML_RESOLVER = yaml.resolver.Resolver()
+# The fast libyaml dumper, if available, for write_header_yaml()
+YAML_CDUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# The FITS block and card sizes for emit_header_fits()
+FITS_BLOCK = 2880
+FITS_CARD = 80
+FITS_END = 'END'.ljust(FITS_CARD)
+# The keywords formatted by fits_native_card(), all others are rendered
+# by cfitsio (see fitsio_card())
+FITS_KEYWORD = re.compile(r'[A-Z0-9_-]{1,8}\Z')
+# Reserved keywords removed by fitsio.FITSHDR.clean() before writing
+FITS_RESERVED = {'SIMPLE', 'EXTEND', 'XTENSION', 'BITPIX', 'PCOUNT', 'GCOUNT', 'THEAP', 'EXTNAME',
+                 'ZQUANTIZ', 'ZDITHER0', 'ZIMAGE', 'ZCMPTYPE', 'ZSIMPLE', 'ZTENSION', 'ZPCOUNT',
+                 'ZGCOUNT', 'ZBITPIX', 'ZEXTEND', 'CHECKSUM', 'DATASUM', 'NAXIS'}
+# Keywords that fitsio.FITSHDR.clean() removes depending on other records
+FITS_CLEAN_CONTEXT = re.compile(r'(NAXIS\d+|ZNAXIS\d*|TFIELDS)\Z')
+# Cache of the cards rendered by cfitsio, see fitsio_card()
+FITS_CARD_CACHE = {}
+# Marker for cache misses in caches that can hold None
+CACHE_MISS = object()
+
 
 def configure_logger(logger, logfile=None, level=logging.NOTSET, log_format=None, log_format_date=None):
     """
@@ -96,9 +151,155 @@ def create_logger(logfile=None, level=logging.NOTSET, log_format=None, log_forma
     return logger
 
 
+def parse_template_value(field):
+    """
+    Parse the value field of a card (after the '=') into the tuple
+    (value_orig, value, dtype, comment) with the same conventions as
+    cfitsio and fitsio.FITSCard. Returns None for the fields that need
+    fitsio (i.e. complex values, numbers that are not plain ints or floats)
+    """
+    field = field.lstrip(' ')
+    if field.startswith("'"):
+        # Look for the closing quote, quotes are escaped as ''
+        end = 1
+        while True:
+            end = field.find("'", end)
+            if end < 0:
+                return None
+            if field[end+1:end+2] != "'":
+                break
+            end += 2
+        value_orig = field[:end+1]
+        value = value_orig[1:-1]
+        dtype = 'C'
+        rest = field[end+1:].lstrip(' ')
+    else:
+        value_orig, slash, rest = field.partition('/')
+        value_orig = value_orig.strip(' ')
+        rest = slash + rest
+        if not value_orig:
+            # cfitsio strips the whole comment of valueless cards
+            comment = rest[1:].strip(' ')
+            if comment.startswith('/'):
+                return None
+            return None, None, '', comment
+        if value_orig in ('T', 'F'):
+            value = value_orig == 'T'
+            dtype = 'L'
+        elif TEMPLATE_INT.match(value_orig):
+            value = int(value_orig)
+            dtype = 'I'
+        elif TEMPLATE_FLOAT.match(value_orig):
+            value = float(value_orig)
+            dtype = 'F'
+        else:
+            return None
+    if not rest:
+        comment = ''
+    elif rest[0] == '/':
+        comment = (rest[2:] if rest[1:2] == ' ' else rest[1:]).rstrip(' ')
+    else:
+        return None
+    return value_orig, value, dtype, comment
+
+
+def parse_template_card(line):
+    """
+    Parse a line of a header template into a record with the same content
+    as fitsio.FITSRecord(line), for keyword (including HIERARCH), blank
+    keyword and COMMENT cards. The other cards are parsed by fitsio.
+    The name of HIERARCH records is 'HIERARCH <name>'.
+    """
+    record = None
+    front = line[0:8]
+    if len(line) > FITS_CARD:
+        # fitsio reports the cards that are too long
+        pass
+    elif front == 'HIERARCH':
+        name, equals, field = line[9:].partition('=')
+        name = name.strip(' ')
+        if line[8:9] == ' ' and equals and name and name == name.upper():
+            record = parse_template_value(field)
+            name = f"HIERARCH {name}"
+    elif line[8:9] == '=':
+        name = front.rstrip(' ')
+        if FITS_KEYWORD.match(name) and name not in ('COMMENT', 'HISTORY', 'CONTINUE'):
+            record = parse_template_value(line[9:])
+    elif front[0:7] == '       ':
+        return {'card_string': line, 'class': TYP_USER_KEY, 'name': None, 'value': None, 'comment': line[8:]}
+    elif front.upper() != 'HIERARCH' and front[0:7] not in ('HISTORY', 'CONTINU'):
+        # Anything else without an = is a COMMENT, like in fitsio
+        return {'card_string': line, 'class': TYP_COMM_KEY, 'name': 'COMMENT', 'value': line[8:]}
+
+    if record is None or name not in KEYWORD_CLASS:
+        # Let fitsio parse it, and keep the keyword class of the name
+        record = fitsio.FITSRecord(line)
+        if check_hierarch(record):
+            record['name'] = f"HIERARCH {record['name']}"
+        KEYWORD_CLASS.setdefault(record['name'], record.get('class'))
+        return record
+
+    value_orig, value, dtype, comment = record
+    return {'card_string': line, 'class': KEYWORD_CLASS[name], 'name': name, 'value_orig': value_orig,
+            'value': value, 'dtype': dtype, 'comment': comment}
+
+
 def read_head_template(fname, header=None):
     """
     Function to read in the templates used for the HeaderService.
+
+    The cards are parsed with parse_template_card() and the records are
+    indexed as they are added, in a single pass, with the same result as
+    read_head_template_fitsio(). HIERARCH records keep the 'HIERARCH'
+    prefix in their name and in the index.
+
+    parameters
+    ----------
+    fname: string
+        The path to the header file
+    header: FITSHDR, optional
+        Optionally combine the header with the input one. The input can
+        be any object convertable to a FITSHDR object
+    returns
+    -------
+    header: FITSHDR
+        A fits header object of type FITSHDR
+    """
+    with open(fname) as fobj:
+        lines = fobj.readlines()
+
+    # if header is None an empty FITSHDR is created
+    hdr = fitsio.FITSHDR(header)
+    record_list = hdr._record_list
+    record_map = hdr._record_map
+    index_map = hdr._index_map
+
+    for line in lines:
+        if line[0:3] == 'END':
+            continue
+        record = parse_template_card(line.rstrip())
+        # Same as FITSHDR.add_record(), only COMMENT, HISTORY, CONTINUE and
+        # blank records can be repeated, other keywords are over-written
+        name = record['name']
+        key = index_key = name.upper() if name is not None else None
+        if key is not None and key.startswith('HIERARCH '):
+            # HIERARCH records are indexed by their full name and mapped by
+            # the name without the prefix, like in read_head_template_fitsio()
+            key = key[9:]
+            index_key = name
+        if key in record_map and key not in ('COMMENT', 'HISTORY', 'CONTINUE', None):
+            record_list[index_map[index_key]] = record
+        else:
+            record_list.append(record)
+            index_map[index_key] = len(record_list) - 1
+        record_map[key] = record
+
+    return hdr
+
+
+def read_head_template_fitsio(fname, header=None):
+    """
+    Function to read in the templates used for the HeaderService.
     This function is based on fitsio.read_scamp_head() and has been
     modified to treat comments (when the KEYWORD field is blank) according
     to the definition of Pence et al. 2010 (section 4.4.2.4)
@@ -145,6 +346,71 @@ def read_head_template(fname, header=None):
     return hdr
 
 
+def get_template_key(fname):
+    """
+    Get the key used to cache a template file in TEMPLATE_CACHE, the key
+    is the tuple (path, mtime, size), so that a template edited on disk is
+    parsed again.
+    """
+    path = os.path.realpath(fname)
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+
+def get_head_template(fname):
+    """
+    Get the parsed FITSHDR prototype for a template file. The template is
+    read and parsed with read_head_template() only once per process, and
+    served from TEMPLATE_CACHE afterwards, only a os.stat() call is made to
+    check that the file did not change.
+
+    The returned FITSHDR is shared across all callers and must not be
+    modified, use HDROverlay() or copy.deepcopy() to make changes
+
+    parameters
+    ----------
+    fname: string
+        The path to the header file
+    returns
+    -------
+    header: FITSHDR
+        A shared fits header object of type FITSHDR
+    """
+    key = get_template_key(fname)
+    if key not in TEMPLATE_CACHE:
+        # Drop stale entries for a template that changed on disk
+        clear_template_cache(fname)
+        TEMPLATE_CACHE[key] = read_head_template(fname)
+    return TEMPLATE_CACHE[key]
+
+
+def clear_template_cache(fname=None):
+    """
+    Invalidate the TEMPLATE_CACHE entries for the template fname, or all of
+    the cached templates if fname is None. The GEOMETRY_CACHE and
+    FRAGMENT_CACHE records are rendered from the templates, so they are
+    invalidated too.
+    """
+    GEOMETRY_CACHE.clear()
+    FRAGMENT_CACHE.clear()
+    if fname is None:
+        TEMPLATE_CACHE.clear()
+        return
+    path = os.path.realpath(fname)
+    for key in [key for key in TEMPLATE_CACHE if key[0] == path]:
+        del TEMPLATE_CACHE[key]
+
+
+def get_geometry_key(vendor, geom, segname):
+    """
+    Get the fingerprint of the geometry of a sensor, used as the key for
+    GEOMETRY_CACHE. These are the only parameters that the DETSEC, DATASEC,
+    DTV and DTM keywords depend on.
+    """
+    return (vendor, int(geom['dimh']), int(geom['dimv']), int(geom['preh']),
+            int(geom['overh']), int(geom['overv']), segname)
+
+
 def check_hierarch(record):
     """Check if record is HIERARCH"""
     card_string = record['card_string']
@@ -221,10 +487,37 @@ def repack_dict_list(mydict, masterkey):
     return newdict
 
 
+@functools.lru_cache(maxsize=None)
+def get_split_esc_patterns(sep=':', esc='\\'):
+    '''
+    The compiled regular expressions and replacement used by split_esc()
+    for the separator (sep) and escape (esc) character
+    '''
+    r1 = r"(?<!\{esc}){sep}".format(esc=esc, sep=sep)
+    r2 = r'\{esc}(.)'.format(esc=esc)
+    r3 = '{esc}1'.format(esc=esc)
+    return re.compile(r1), re.compile(r2), r3
+
+
+@functools.lru_cache(maxsize=256)
+def split_esc_cached(s, sep=':', esc='\\'):
+    '''
+    Split a string using separator (sep) and escape (esc) character, as
+    a tuple cached by payload, see split_esc()
+    '''
+    # Fast path for payloads without escapes, when sep is not a pattern
+    if esc not in s and re.escape(sep) == sep:
+        return tuple(s.split(sep))
+    split, unescape, repl = get_split_esc_patterns(sep, esc)
+    return tuple(unescape.sub(repl, k) for k in split.split(s))
+
+
 def split_esc(s, sep=':', esc='\\'):
 
     '''
-    Split a string using separator (sep) and escape (esc) character
+    Split a string using separator (sep) and escape (esc) character.
+    Payloads like the ccdLocation list are split many times per image, so
+    the splits are cached with split_esc_cached()
     '''
 
     # We want to replicate the spliting of string:
@@ -239,13 +532,8 @@ def split_esc(s, sep=':', esc='\\'):
     # print([re.sub(r'\\(.)','\\1',k) for k in re.split(r'(?<!\\):', s)])
     # ['OBJECT', '2020-06-16T18:43:55.039', 'OBJ\\ECT']
 
-    # The regular expresions we'll use
-    r1 = r"(?<!\{esc}){sep}".format(esc=esc, sep=sep)
-    r2 = r'\{esc}(.)'.format(esc=esc)
-    r3 = '{esc}1'.format(esc=esc)
-    arr = [re.sub(r2, r3, k) for k in re.split(r1, s)]
-
-    return arr
+    # Return a new list, as callers could modify it
+    return list(split_esc_cached(s, sep, esc))
 
 
 def get_image_size_from_imageReadoutParameters(myData, array_key='ccdLocation', sep=":"):
@@ -324,6 +612,560 @@ def build_sensor_list(instrument, sep=""):
     return sensor_names
 
 
+def yaml_allow_plain(value):
+    """
+    Port of the rules for block plain scalars of PyYAML (see
+    yaml.emitter.Emitter.analyze_scalar) for printable ASCII strings
+    """
+    if value.startswith('---') or value.startswith('...'):
+        return False
+    if value[0] == ' ' or value[-1] == ' ' or value[0] in YAML_INDICATORS:
+        return False
+    if value[0] in '?:-' and value[1:2] in ('', ' '):
+        return False
+    if ': ' in value[1:] or (len(value) > 1 and value[-1] == ':') or ' #' in value:
+        return False
+    # Plain strings that would be loaded as other types need quotes
+    return YAML_RESOLVER.resolve(yaml.ScalarNode, value, (True, False)) == YAML_STR_TAG
+
+
+@functools.lru_cache(maxsize=8192)
+def yaml_str(value, column):
+    """
+    The YAML scalar for a string starting at column, as written by
+    yaml.dump(). Returns None when the string needs the full PyYAML emitter
+    (non-printable or non-ASCII characters, folding of long lines)
+    """
+    if not value:
+        return "''"
+    if not (value.isascii() and value.isprintable()):
+        return None
+    if yaml_allow_plain(value):
+        text = value
+    else:
+        text = "'" + value.replace("'", "''") + "'"
+    # Long lines are folded by PyYAML at the spaces
+    if column + len(text) > YAML_WIDTH and ' ' in text:
+        return None
+    return text
+
+
+def yaml_scalar(value, column):
+    """
+    The YAML scalar for the value of a record starting at column, as
+    written by yaml.dump(). Returns None for values that need the full
+    PyYAML emitter (i.e. numpy types or complex strings)
+    """
+    vtype = type(value)
+    if vtype is str:
+        return yaml_str(value, column)
+    if value is None:
+        return 'null'
+    if vtype is bool:
+        return 'true' if value else 'false'
+    if vtype is int:
+        return str(value)
+    if vtype is float:
+        # Same as yaml.representer.SafeRepresenter.represent_float()
+        if value != value:
+            return '.nan'
+        if value == float('inf'):
+            return '.inf'
+        if value == -float('inf'):
+            return '-.inf'
+        text = repr(value).lower()
+        if '.' not in text and 'e' in text:
+            text = text.replace('e', '.0e', 1)
+        return text
+    return None
+
+
+def yaml_record(rec):
+    """
+    The YAML text of a record as an item of the list of its extension, or
+    None if the record needs the full PyYAML emitter
+    """
+    # The columns are the lengths of '- keyword: ', '  value: ' and
+    # '  comment: '
+    keyword = yaml_scalar(rec['name'], 11)
+    value = yaml_scalar(rec['value'], 9)
+    comment = yaml_scalar(rec.get('comment', ''), 11)
+    if keyword is None or value is None or comment is None:
+        return None
+    return f"- keyword: {keyword}\n  value: {value}\n  comment: {comment}\n"
+
+
+def emit_header_yaml(extensions):
+    """
+    Streaming YAML emitter for the fixed {extname: [{keyword, value,
+    comment}]} schema of the headers, with the same output as yaml.dump()
+    with default_flow_style=False and sort_keys=False.
+
+    parameters:
+      extensions: list of (extname, HDROverlay) tuples
+    returns:
+      The YAML text or None if a record needs the full PyYAML emitter
+    """
+    chunks = []
+    for extname, overlay in extensions:
+        key = yaml_str(extname, 0) if type(extname) is str and len(extname) < YAML_WIDTH else None
+        if key is None:
+            return None
+        if not len(overlay):
+            chunks.append(f"{key}: []\n")
+            continue
+        text = overlay.serialize(yaml_record)
+        if text is None:
+            return None
+        chunks.append(f"{key}:\n")
+        chunks.append(text)
+    return ''.join(chunks)
+
+
+def fits_float(value):
+    """Format a float like cfitsio does for fits_update_key_dbl()"""
+    if value != value or value in (float('inf'), -float('inf')):
+        return None
+    text = '%.15G' % value
+    if '.' not in text:
+        if 'E' in text:
+            text = text.replace('E', '.0E', 1)
+        else:
+            text += '.'
+    return text
+
+
+def fits_native_card(name, value, comment):
+    """
+    Format the card of a keyword with a standard name and a single card
+    value, the same way that cfitsio does when called by fitsio. Returns
+    None for everything else (long strings, HIERARCH, numpy types, ...)
+    """
+    if not (comment.isascii() and comment.isprintable()):
+        return None
+    if name is None:
+        card = '        ' + comment
+    elif name == 'COMMENT':
+        if type(value) is not str or not (value.isascii() and value.isprintable()) or len(value) > 72:
+            return None
+        # cfitsio does not write empty comments
+        if not value:
+            return ''
+        card = 'COMMENT ' + value
+    elif name in ('HISTORY', 'CONTINUE') or not FITS_KEYWORD.match(name):
+        return None
+    else:
+        vtype = type(value)
+        if value is None:
+            field = ''.rjust(20)
+        elif vtype is bool:
+            field = ('T' if value else 'F').rjust(20)
+        elif vtype is int:
+            if not -2**63 <= value < 2**63:
+                return None
+            field = str(value).rjust(20)
+        elif vtype is float:
+            field = fits_float(value)
+            if field is None:
+                return None
+            field = field.rjust(20)
+        elif vtype is str:
+            field = value.replace("'", "''")
+            if len(field) > 68 or not (value.isascii() and value.isprintable()):
+                return None
+            field = f"'{field:<8}'".ljust(20)
+        else:
+            return None
+        card = f"{name:<8}= {field}"
+        if comment:
+            card = f"{card} / {comment}"
+    if len(card) > FITS_CARD:
+        return None
+    return card.ljust(FITS_CARD)
+
+
+def fitsio_headers(headers):
+    """
+    Write the headers (lists of records) with fitsio as empty HDUs of an
+    in-memory FITS file, and return the list of cards for each HDU
+    (without the END card)
+    """
+    with fitsio.FITS('mem://', 'rw', ignore_empty=True) as fits:
+        for header in headers:
+            fits.write(None, header=header)
+        raw = fits.read_raw().decode('ascii')
+    hdus = []
+    cards = []
+    index = 0
+    while index < len(raw):
+        card = raw[index:index+FITS_CARD]
+        index += FITS_CARD
+        if card == FITS_END:
+            hdus.append(cards)
+            cards = []
+            # Skip the padding to the next block
+            index = -(-index // FITS_BLOCK) * FITS_BLOCK
+        else:
+            cards.append(card)
+    return hdus
+
+
+@functools.lru_cache(maxsize=None)
+def get_fits_preamble():
+    """
+    The cards written by cfitsio when creating the empty PRIMARY and IMAGE
+    HDUs, before the EXTNAME and the records
+    """
+    primary, image = fitsio_headers([[], []])
+    return ''.join(primary), ''.join(image)
+
+
+def fitsio_card(rec):
+    """
+    Render the card(s) of a record with cfitsio, for the records that
+    fits_native_card() cannot format. The cards are cached in
+    FITS_CARD_CACHE, and None is returned if fitsio cannot write the record
+    """
+    value = rec['value']
+    comment = rec.get('comment', '')
+    key = (rec['name'], type(value), repr(value), type(comment), repr(comment))
+    # The cache can be shared with the threads writing headers, so the
+    # entry is read only once
+    card = FITS_CARD_CACHE.get(key, CACHE_MISS)
+    if card is CACHE_MISS:
+        if len(FITS_CARD_CACHE) >= 4096:
+            FITS_CARD_CACHE.clear()
+        try:
+            cards = fitsio_headers([[], [rec]])[1]
+            card = ''.join(cards)[len(get_fits_preamble()[1]):]
+        except Exception:
+            # Let the fitsio writer report the error
+            card = None
+        FITS_CARD_CACHE[key] = card
+    return card
+
+
+def fits_card(rec):
+    """
+    The header card(s) written by fitsio.FITS.write() for a record, as a
+    string of 80-character cards. Returns '' for the reserved keywords
+    removed by fitsio.FITSHDR.clean(), and None if the record cannot be
+    written or depends on other records of the header
+    """
+    name = rec['name']
+    if name is not None:
+        if type(name) is not str or name != name.upper() or FITS_CLEAN_CONTEXT.match(name):
+            return None
+        if name in FITS_RESERVED:
+            return '' if name != 'NAXIS' or type(rec['value']) is int else None
+    card = fits_native_card(name, rec['value'], str(rec.get('comment', '')))
+    if card is None:
+        card = fitsio_card(rec)
+    return card
+
+
+def emit_header_fits(extensions):
+    """
+    Header-only FITS writer for the empty HDUs of the headers, with the
+    same output as fitsio.FITS.write(None, header=records, extname=extname)
+    for each extension. The cards of each HDU are padded to 2880-byte
+    blocks and returned in a single buffer.
+
+    fitsio creates each HDU with space reserved for all of the records
+    passed, including the ones that are not written (i.e. reserved
+    keywords and empty comments), and cfitsio writes the END card after
+    the last record but never before the last block of the header space.
+
+    parameters:
+      extensions: list of (extname, HDROverlay) tuples
+    returns:
+      The FITS bytes or None if a record needs the fitsio writer
+    """
+    primary, image = get_fits_preamble()
+    block_cards = FITS_BLOCK // FITS_CARD
+    blocks = []
+    for extname, overlay in extensions:
+        extcard = fits_native_card('EXTNAME', extname, '') if type(extname) is str else None
+        text = overlay.serialize(fits_card)
+        if extcard is None or text is None:
+            return None
+        preamble = (image if blocks else primary) + extcard
+        cards = preamble + text
+        ncards = len(cards) // FITS_CARD
+        reserved = len(preamble) // FITS_CARD + len(overlay)
+        nblocks = -(-(max(ncards, reserved) + 1) // block_cards)
+        end = max(ncards, (nblocks - 1) * block_cards)
+        header = cards.ljust(end * FITS_CARD) + FITS_END
+        blocks.append(header.ljust(nblocks * FITS_BLOCK))
+    return ''.join(blocks).encode('ascii')
+
+
+class RingBuffer:
+    """
+    A ring buffer of (timestamp, value) samples of fixed size. Samples are
+    written twice, at k and k+size, so the last `size` samples in time
+    order are always a contiguous slice of the arrays and can be
+    selected by time without copies.
+
+    Without a dtype, the values are integers if the first sample is an
+    integer (so their reductions stay integers) and floats otherwise. An
+    integer buffer is converted to floats with the first float sample
+    """
+
+    def __init__(self, size=1024, dtype=None):
+        self.size = size
+        self.count = 0
+        self.times = numpy.zeros(2*size)
+        self.values = numpy.zeros(2*size, dtype=dtype or float)
+        self.dtype = dtype
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, timestamp, value):
+        """Add a sample, overwriting the oldest one if the buffer is full"""
+        if self.dtype is None:
+            integer = isinstance(value, numbers.Integral)
+            if self.count == 0 and integer:
+                self.values = self.values.astype(numpy.int64)
+            elif self.values.dtype.kind == 'i' and not integer:
+                self.values = self.values.astype(float)
+        k = self.count % self.size
+        self.values[k] = self.values[k+self.size] = value
+        self.times[k] = self.times[k+self.size] = timestamp
+        self.count += 1
+
+    def view(self):
+        """The (times, values) of the samples in the buffer in time order"""
+        if self.count < self.size:
+            start, end = 0, self.count
+        else:
+            start = self.count % self.size
+            end = start + self.size
+        return self.times[start:end], self.values[start:end]
+
+    def window(self, t0, t1):
+        """
+        Get the values of the samples with t0 <= timestamp <= t1. Also
+        returns False if older samples in the window were overwritten
+        """
+        times, values = self.view()
+        i0 = numpy.searchsorted(times, t0, side='left')
+        i1 = numpy.searchsorted(times, t1, side='right')
+        complete = bool(self.count <= self.size or i0 > 0)
+        return values[i0:i1], complete
+
+
+class HDRFragments:
+
+    """
+    The records of a template with the shared records of an extension (i.e.
+    the geometry) on top, pre-serialized once with a render function. The
+    static text before, between and after the slots updated for an image
+    is joined and cached for each set of updated slots (layout), so that
+    only the updated records need to be rendered (see HDROverlay.serialize)
+    """
+
+    # Maximum number of layouts kept per template/base combination
+    max_layouts = 32
+
+    def __init__(self, template, base, render):
+        self.template = template
+        self.base = base
+        self.texts = [render(base.get(index, rec)) for index, rec in enumerate(template._record_list)]
+        self.layouts = {}
+
+    def get_chunks(self, slots):
+        """
+        Get the list of len(slots)+1 chunks of static text around the sorted
+        tuple of slots, or None if a static record cannot be rendered
+        """
+        chunks = self.layouts.get(slots, CACHE_MISS)
+        if chunks is not CACHE_MISS:
+            return chunks
+        bounds = (-1,) + slots + (len(self.texts),)
+        chunks = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            texts = self.texts[start+1:end]
+            if None in texts:
+                chunks = None
+                break
+            chunks.append(''.join(texts))
+        if len(self.layouts) >= self.max_layouts:
+            self.layouts.clear()
+        self.layouts[slots] = chunks
+        return chunks
+
+
+def get_fragments(template, base, render, shared=True):
+    """
+    Get the HDRFragments for the template/base combination from
+    FRAGMENT_CACHE. The cache is keyed by the identity of the objects (it
+    holds a reference to them), so only shared base dictionaries that are
+    never modified, like the ones in GEOMETRY_CACHE, can be cached. It is
+    cleared when it reaches 1024 entries
+    """
+    if not shared:
+        return HDRFragments(template, base, render)
+    key = (id(template), id(base) if base else None, render)
+    fragments = FRAGMENT_CACHE.get(key)
+    if fragments is None:
+        fragments = HDRFragments(template, base, render)
+        if len(FRAGMENT_CACHE) >= 1024:
+            FRAGMENT_CACHE.clear()
+        FRAGMENT_CACHE[key] = fragments
+    return fragments
+
+
+class HDROverlay:
+
+    """
+    Copy-on-write header for one extension. It holds a shared FITSHDR
+    template that is never modified, and two small dictionaries with the
+    records that were overridden for this extension, keyed to the index of
+    the record in the template: the shared records (base) that are set for
+    many images (i.e. the geometry, see set_overrides()), and the records
+    updated for this image (overrides). Reads, iteration and serialization
+    see the template records with the base and overrides on top, without a
+    full copy of the template.
+
+    The 'card_string' of an overridden record is rendered lazily: it is set
+    to None (dirty) when the value changes and only rendered when needed by
+    render_cards() or get_record(), the YAML writer never needs it.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.base = {}
+        self.shared = True
+        self.overrides = {}
+
+    def __contains__(self, keyword):
+        return keyword in self.template._index_map
+
+    def __getitem__(self, keyword):
+        return self.get_record(keyword)['value']
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.template._record_list)
+
+    def keys(self):
+        """Return the list of keywords, in the order of the template"""
+        return [rec['name'] for rec in self.records()]
+
+    def lookup(self, index):
+        """Get the current record with index in the template"""
+        return self.overrides.get(index) or self.base.get(index) or self.template._record_list[index]
+
+    def get_record(self, keyword):
+        """Get the current record for keyword, with its card rendered"""
+        index = self.template._index_map[keyword]
+        if index in self.overrides or index in self.base:
+            return self.render_card(self.lookup(index))
+        return self.template._record_list[index]
+
+    def update_record(self, keyword, value):
+        """
+        Update the value of the record for keyword. Records are never
+        modified in place, we store a new copy in the overrides, so that
+        records can be shared between overlays (see set_overrides())
+        """
+        self.update_slot(self.template._index_map[keyword], value)
+
+    def update_slot(self, index, value):
+        """
+        Update the value of the record with index in the template, for
+        callers that already looked up the index (see HDRTEMPL.keyword_index)
+        """
+        rec = dict(self.lookup(index))
+        rec['value'] = value
+        rec['card_string'] = None
+        self.overrides[index] = rec
+
+    def get_overrides(self, newdict):
+        """
+        Make the records for the keyword/values in newdict on top of the
+        template, without applying them. Keywords not in the template are
+        ignored. Returns a dictionary that can be passed to set_overrides()
+        """
+        overrides = {}
+        for keyword, value in newdict.items():
+            if keyword not in self:
+                continue
+            index = self.template._index_map[keyword]
+            rec = dict(self.template._record_list[index])
+            rec['value'] = value
+            rec['card_string'] = None
+            overrides[index] = rec
+        return overrides
+
+    def set_overrides(self, overrides):
+        """
+        Apply the records from get_overrides() as shared records (base),
+        replacing the ones updated before for this image. The dictionary is
+        kept as is and must not be modified, so that the serialized records
+        can be cached for it (see serialize())
+        """
+        for index in overrides:
+            self.overrides.pop(index, None)
+        if self.base.keys() <= overrides.keys():
+            self.base = overrides
+            self.shared = True
+        else:
+            self.base = {**self.base, **overrides}
+            self.shared = False
+
+    def render_card(self, rec):
+        """
+        Render the card_string of an overridden record if dirty. This is
+        safe for shared records, as the card only depends on the record.
+        """
+        if rec['card_string'] is None:
+            rec['card_string'] = self.template._record2card(rec)
+        return rec
+
+    def render_cards(self):
+        """Render the card_string of all the dirty records"""
+        for rec in itertools.chain(self.base.values(), self.overrides.values()):
+            self.render_card(rec)
+
+    def records(self):
+        """
+        Return the list of records with the overrides on top of the
+        template. The records are shared and must not be modified, call
+        render_cards() first if the card_string is needed
+        """
+        if not self.overrides and not self.base:
+            return list(self.template._record_list)
+        return [self.overrides.get(index) or self.base.get(index) or rec
+                for index, rec in enumerate(self.template._record_list)]
+
+    def serialize(self, render):
+        """
+        Serialize the records with render(rec), that returns the text of a
+        record or None if it cannot be rendered. The template and shared
+        records are pre-serialized once (see HDRFragments), and only the
+        records updated for this image are rendered and spliced in between.
+        Returns the text, or None if any of the records cannot be rendered
+        """
+        fragments = get_fragments(self.template, self.base, render, shared=self.shared)
+        slots = tuple(sorted(self.overrides))
+        chunks = fragments.get_chunks(slots)
+        if chunks is None:
+            return None
+        text = [chunks[0]]
+        for slot, chunk in zip(slots, chunks[1:]):
+            rec = render(self.overrides[slot])
+            if rec is None:
+                return None
+            text.append(rec)
+            text.append(chunk)
+        return ''.join(text)
+
+
 # Generic class for LATISS/ComCam/LSSTCam
 class HDRTEMPL:
 
@@ -335,6 +1177,8 @@ class HDRTEMPL:
                  instrument=None,
                  segname='Segment',
                  write_mode='yaml',
+                 yaml_emitter='native',
+                 fits_writer='native',
                  templ_path=None,
                  nosensors=False,
                  templ_primary_name='primary_hdu.header',
@@ -350,6 +1194,8 @@ class HDRTEMPL:
         self.templ_primary_sensor_name = templ_primary_sensor_name
         self.templ_segment_name = templ_segment_name
         self.write_mode = write_mode
+        self.yaml_emitter = yaml_emitter
+        self.fits_writer = fits_writer
         self.segname = segname
         self.nosensors = nosensors
 
@@ -370,10 +1216,8 @@ class HDRTEMPL:
         else:
             nsegments = 16
         # Build the HDRLIST (PRIMARY, PRIMARY_COMMON, Segment01,...,Segment17)
-        self.build_hdrlist(n=nsegments)
-
-        # Load/Create CCDGEOM object per sensor
-        self.load_CCDInfo()
+        # and the CCDGEOM object per sensor, or get them from the cache
+        self.load_layout(n=nsegments)
 
         # Set the mimeType
         self.set_mimeType()
@@ -402,6 +1246,34 @@ class HDRTEMPL:
         else:
             self.log.warning(f"No SENSOR template for {self.instrument}")
 
+    def load_layout(self, n=16):
+        """
+        Load the HDRLIST, segment names, vendors and CCDInfo objects for
+        the camera configuration from LAYOUT_CACHE, or build them with
+        build_hdrlist() and load_CCDInfo() for a new configuration. They
+        are shared between headers and are never modified.
+        """
+        key = (self.instrument, self.segname, self.nosensors, n, tuple(sorted(self.templ_file.items())),
+               tuple(self.sensor_names), tuple(self.vendor_names))
+        layout = LAYOUT_CACHE.get(key)
+        if layout is None:
+            self.build_hdrlist(n=n)
+            self.load_CCDInfo()
+            if len(LAYOUT_CACHE) >= 16:
+                LAYOUT_CACHE.clear()
+            layout = {'HDRLIST': self.HDRLIST,
+                      'segment_names': getattr(self, 'segment_names', {}),
+                      'vendor': getattr(self, 'vendor', {}),
+                      'CCDInfo': self.CCDInfo}
+            LAYOUT_CACHE[key] = layout
+        else:
+            self.log.info(f"Using cached HDRlist for {self.instrument}")
+            self.HDRLIST = layout['HDRLIST']
+            self.segment_names = layout['segment_names']
+            self.vendor = layout['vendor']
+            self.CCDInfo = layout['CCDInfo']
+        self.layout = layout
+
     def build_hdrlist(self, n=16):
         """
         Function to build the list of HDUs into the headers. For LATISS each of
@@ -464,77 +1336,170 @@ class HDRTEMPL:
 
     def load_templates(self):
 
-        # Read in the primary and segment templates with fitsio
-        self.header_primary = read_head_template(self.templ_file['PRIMARY'])
+        # Get the primary and segment templates from the process-wide cache,
+        # these are shared and are never modified
+        self.header_primary = get_head_template(self.templ_file['PRIMARY'])
 
         # Ignore SEGMENT and SENSOR if files are not there
         if 'SEGMENT' in self.templ_file:
-            self.header_segment = read_head_template(self.templ_file['SEGMENT'])
+            self.header_segment = get_head_template(self.templ_file['SEGMENT'])
         # Sensor is optional
         if 'SENSOR' in self.templ_file:
-            self.header_primary_sensor = read_head_template(self.templ_file['SENSOR'])
+            self.header_primary_sensor = get_head_template(self.templ_file['SENSOR'])
 
-        # Start loadin templates into the self.header object
+        # Start loadin templates into the self.header object, each extension
+        # is a copy-on-write HDROverlay on top of the shared template
         # 1. Load up the template for the PRIMARY header
         # The main structure that will host the header object
         self.header = {}
-        self.header['PRIMARY'] = self.header_primary
-        PRIMARY_DATA = camera_coords.setup_primary()
-        self.update_records(PRIMARY_DATA, 'PRIMARY')
+        self.header['PRIMARY'] = HDROverlay(self.header_primary)
         self.log.info("Loading template for: PRIMARY")
+        # The geometry fingerprint loaded for each sensor
+        self.geometry_key = {}
 
         # 2. Load up segments (and PRIMARY_SENSOR if needed)
         for sensor in self.sensor_names:
-
             if 'SENSOR' in self.templ_file:
                 # Get the extname for the primary/sensor combo
                 extname = self.get_primary_extname(sensor)
-                self.header[extname] = copy.deepcopy(self.header_primary_sensor)
-                PRIMARY_DATA_SENSOR = self.CCDInfo[sensor].setup_primary_sensor()
                 self.log.debug(f"Loading template for: {extname}")
-                self.update_records(PRIMARY_DATA_SENSOR, extname)
-
+                self.header[extname] = HDROverlay(self.header_primary_sensor)
             # Loop over all segment in Sensor/CCD
             if 'SEGMENT' in self.templ_file:
                 for seg in self.segment_names[sensor]:
                     # Get the right extname for sensor/segment combination
                     extname = self.get_segment_extname(sensor, seg)
                     self.log.debug(f"Loading template for: {extname}")
-                    self.header[extname] = copy.deepcopy(self.header_segment)
+                    self.header[extname] = HDROverlay(self.header_segment)
+
+        # 3. Index the records of all extensions before we update them
+        self.build_keyword_index()
+
+        # 4. Update the templates with the non-telemetry data
+        PRIMARY_DATA = camera_coords.setup_primary()
+        self.update_many(PRIMARY_DATA, 'PRIMARY')
+        for sensor in self.sensor_names:
+            if 'SENSOR' in self.templ_file:
+                extname = self.get_primary_extname(sensor)
+                PRIMARY_DATA_SENSOR = self.CCDInfo[sensor].setup_primary_sensor()
+                self.update_many(PRIMARY_DATA_SENSOR, extname)
+            if 'SEGMENT' in self.templ_file:
+                for seg in self.segment_names[sensor]:
                     # Now get the new values for the SEGMENT
+                    extname = self.get_segment_extname(sensor, seg)
                     self.log.debug(f"Updating DATA in template for: {extname}")
                     SEGMENT_DATA = self.CCDInfo[sensor].setup_segment(seg)
-                    self.update_records(SEGMENT_DATA, extname)
+                    self.update_many(SEGMENT_DATA, extname)
+
+    def build_keyword_index(self):
+        """
+        Build the index keyword -> {extname: slot} with the position (slot)
+        of the record for keyword in the template of each extension, so
+        that updates do not need to search the templates
+        """
+        # The index is the same for all headers of the camera configuration
+        # with the same templates, and is kept with the layout
+        templates = [overlay.template for overlay in self.header.values()]
+        cached = self.layout.get('keyword_index')
+        if cached is not None and len(cached[0]) == len(templates) and \
+                all(a is b for a, b in zip(cached[0], templates)):
+            self.keyword_index = cached[1]
+            return
+        self.keyword_index = {}
+        for extname, overlay in self.header.items():
+            for keyword, slot in overlay.template._index_map.items():
+                self.keyword_index.setdefault(keyword, {})[extname] = slot
+        self.layout['keyword_index'] = (templates, self.keyword_index)
 
     def load_geometry(self, geom):
         """
         Function to update geometry information once the parameters are known
         because they were received from a camera event. This is a lighter task
-        than uploading the header templates again
+        than uploading the header templates again.
+
+        The rendered records are cached in GEOMETRY_CACHE keyed by the
+        geometry fingerprint of the sensor (see get_geometry_key()), as the
+        readout parameters hardly ever change between exposures. The cache
+        is cleared when it is full, so the records are read only once here.
         """
 
         self.log.info("Loading geometry for header")
-        # Load up the template for the PRIMARY header
+        # Get the geometry fingerprint for all sensors, and compute the
+        # records of the new ones in one batched call
+        cache_keys = {}
+        geometries = {}
+        missing = {}
         for sensor in self.sensor_names:
-            # Get the extname for the primary/sensor combo
-            extname = self.get_primary_extname(sensor)
-            # Get the updated primary data
-            self.CCDInfo[sensor].update_geom_params(geom[sensor])
-            PRIMARY_DATA = self.CCDInfo[sensor].setup_primary_geom()
+            key = get_geometry_key(self.vendor[sensor], geom[sensor], self.segname)
+            cache_keys[sensor] = (self.templ_file.get('SENSOR'), self.templ_file.get('SEGMENT'), key)
+            geometry = GEOMETRY_CACHE.get(cache_keys[sensor])
+            if geometry is None:
+                missing.setdefault(cache_keys[sensor], sensor)
+            else:
+                geometries[cache_keys[sensor]] = geometry
+        if missing:
+            self.log.info(f"Computing geometry records for {len(missing)} geometries")
+            geometries.update(self.cache_geometry_overrides(list(missing.values()), geom, cache_keys))
+
+        for sensor in self.sensor_names:
+            key = cache_keys[sensor][-1]
+            # Nothing to do if the same geometry is already loaded
+            if self.geometry_key.get(sensor) == key:
+                self.log.debug(f"Geometry unchanged for: {sensor}")
+                continue
+            geometry = geometries[cache_keys[sensor]]
             # Load up the new PRIMARY_DATA, here we either update PRIMARY
             # or PRIMARY_SENSOR which is defined by {extname}
-            self.log.info(f"Updating records for: {extname}")
-            self.update_records(PRIMARY_DATA, extname)
+            extname = self.get_primary_extname(sensor)
+            self.log.debug(f"Updating records for: {extname}")
+            self.header[extname].set_overrides(geometry['PRIMARY'])
             # Loop over all segment in Sensor/CCD
             for seg in self.segment_names[sensor]:
                 # Get the right extnamme for sensor/segment combination
                 extname = self.get_segment_extname(sensor, seg)
                 self.log.debug(f"Updating geom for: {extname}")
-                SEGMENT_DATA = self.CCDInfo[sensor].setup_segment_geom(seg)
-                self.update_records(SEGMENT_DATA, extname)
+                self.header[extname].set_overrides(geometry[seg])
+            self.geometry_key[sensor] = key
+
+    def cache_geometry_overrides(self, sensors, geom, cache_keys):
+        """
+        Compute the geometry for a list of sensors in one batched call to
+        camera_coords.get_mosaic_arrays(), and store the rendered records in
+        GEOMETRY_CACHE as a dictionary keyed to 'PRIMARY' and the segment
+        names with the overrides for each extension. The new records are
+        also returned keyed to the cache keys
+        """
+        geometries = {}
+        segments = self.segment_names[sensors[0]]
+        mosaic = camera_coords.get_mosaic_arrays([self.vendor[sensor] for sensor in sensors],
+                                                 [geom[sensor]['dimh'] for sensor in sensors],
+                                                 [geom[sensor]['dimv'] for sensor in sensors],
+                                                 [geom[sensor]['preh'] for sensor in sensors],
+                                                 segments=segments)
+        for i, sensor in enumerate(sensors):
+            geometry = {}
+            # DETSIZE and DATASEC are the same for all segments
+            PRIMARY_DATA = {'DETSIZE': mosaic['DETSIZE'][i].item()}
+            extname = self.get_primary_extname(sensor)
+            geometry['PRIMARY'] = self.header[extname].get_overrides(PRIMARY_DATA)
+            for j, seg in enumerate(segments):
+                SEGMENT_DATA = {key: mosaic[key][i, j].item() for key in camera_coords.MOSAIC_KEYS}
+                SEGMENT_DATA['DETSIZE'] = PRIMARY_DATA['DETSIZE']
+                SEGMENT_DATA['DATASEC'] = mosaic['DATASEC'][i].item()
+                SEGMENT_DATA['EXTNAME'] = '{}{}'.format(self.segname, seg)
+                extname = self.get_segment_extname(sensor, seg)
+                geometry[seg] = self.header[extname].get_overrides(SEGMENT_DATA)
+            # The fragments hold a reference to the geometry records, so
+            # they are cleared together
+            if len(GEOMETRY_CACHE) >= 64:
+                GEOMETRY_CACHE.clear()
+                FRAGMENT_CACHE.clear()
+            GEOMETRY_CACHE[cache_keys[sensor]] = geometry
+            geometries[cache_keys[sensor]] = geometry
+        return geometries
 
     def get_record(self, keyword, extname):
-        return get_record(self.header[extname], keyword)
+        return self.header[extname].get_record(keyword)
 
     def get_header_values(self):
         return get_values(self.header)
@@ -543,23 +1508,68 @@ class HDRTEMPL:
         """ Update record for key with value """
         # Only update if keyword is already in the template
         # otherwise ignore
-        if keyword not in self.header[extname]._index_map:
+        slot = self.keyword_index.get(keyword, {}).get(extname)
+        if slot is None:
             self.log.info(f"Ignoring {keyword} not in {extname} template")
         else:
             self.log.debug(f"Updating {keyword} for {extname}")
-            rec = self.get_record(keyword, extname)
-            rec['value'] = value
-            rec['card_string'] = self.header[extname]._record2card(rec)
+            self.header[extname].update_slot(slot, value)
 
     def update_records(self, newdict, extname):
         """
-        Update all records in a new dictionary, it calls self.update_record()
+        Update all records in a new dictionary, it calls self.update_many()
         """
-        for keyword, value in newdict.items():
-            self.update_record(keyword, value, extname)
+        self.update_many(newdict, extname)
 
-    def write_header_yaml(self, filename):
-        """Write a header file in yaml format"""
+    def update_many(self, newdict, extname='PRIMARY'):
+        """
+        Update the records for extname with all the keyword/values in
+        newdict in one pass. Keywords that are not in the template are
+        ignored and reported once.
+        """
+        overlay = self.header[extname]
+        ignored = []
+        for keyword, value in newdict.items():
+            slot = self.keyword_index.get(keyword, {}).get(extname)
+            if slot is None:
+                ignored.append(keyword)
+            else:
+                overlay.update_slot(slot, value)
+        self.log.debug(f"Updated {len(newdict) - len(ignored)} records for {extname}")
+        if ignored:
+            self.log.info(f"Ignoring {len(ignored)} keywords not in {extname} template: {ignored}")
+
+    def update_per_sensor(self, newdict):
+        """
+        Update the PRIMARY extension of each sensor in one pass, newdict
+        holds per-sensor values with the form {keyword: {sensor: value}}.
+        Keywords that are not in the templates are ignored and reported once.
+        """
+        ignored = []
+        for keyword, values in newdict.items():
+            slots = self.keyword_index.get(keyword, {})
+            for sensor, value in values.items():
+                extname = self.get_primary_extname(sensor)
+                slot = slots.get(extname)
+                if slot is None:
+                    ignored.append(f"{keyword}[{sensor}]")
+                else:
+                    self.header[extname].update_slot(slot, value)
+        if ignored:
+            self.log.info(f"Ignoring {len(ignored)} per-sensor keywords not in templates: {ignored}")
+
+    def render_header_yaml(self):
+        """
+        Render the header in yaml format as bytes. The yaml_emitter can be:
+        'native' (emit_header_yaml), 'libyaml' (yaml.CSafeDumper) or
+        'pyyaml' (yaml.Dumper). The native emitter falls back to PyYAML
+        for records it cannot handle
+        """
+        if self.yaml_emitter == 'native':
+            text = emit_header_yaml([(extname, self.header[extname]) for extname in self.HDRLIST])
+            if text is not None:
+                return text.encode('utf-8')
+            self.log.debug("Native yaml emitter cannot write header, falling back to PyYAML")
 
         # The dict where we will store the header contents
         yaml_header = {}
@@ -572,43 +1582,65 @@ class HDRTEMPL:
             recs = self.header[extname].records()
             for rec in recs:
                 # Avoid undef comments and set them as empty strings
-                if 'comment' not in rec:
-                    rec['comment'] = ''
                 new_rec = {'keyword': rec['name'],
                            'value': rec['value'],
-                           'comment': rec['comment']}
+                           'comment': rec.get('comment', '')}
                 yaml_header[extname].append(new_rec)
 
-        # Write out directly using yaml
-        with open(filename, 'w') as outfile:
-            yaml.dump(yaml_header, outfile, default_flow_style=False, sort_keys=False)
+        # Dump directly using yaml
+        Dumper = YAML_CDUMPER if self.yaml_emitter == 'libyaml' else yaml.Dumper
+        text = yaml.dump(yaml_header, Dumper=Dumper, default_flow_style=False, sort_keys=False)
+        return text.encode('utf-8')
+
+    def render_header_fits(self):
+        """
+        Render the header using the FITS format with empty HDUs as bytes.
+        The fits_writer can be: 'native' (emit_header_fits) or 'fitsio'. The
+        native writer falls back to fitsio for records it cannot handle
+        """
+        if self.fits_writer == 'native':
+            blocks = emit_header_fits([(extname, self.header[extname]) for extname in self.HDRLIST])
+            if blocks is not None:
+                return blocks
+            self.log.debug("Native FITS writer cannot write header, falling back to fitsio")
 
-    def write_header_fits(self, filename):
-        """Write a header file using the FITS format with empty HDUs"""
         data = None
-        with fitsio.FITS(filename, 'rw', clobber=True, ignore_empty=True) as fits:
+        with fitsio.FITS('mem://', 'rw', ignore_empty=True) as fits:
             for extname in self.HDRLIST:
-                hdr = copy.deepcopy(self.header[extname])
-                fits.write(data, header=hdr, extname=extname)
-
-    def write_header(self, filename):
+                # Render the cards deferred since the last update
+                self.header[extname].render_cards()
+                # fitsio makes its own FITSHDR from the list of records, so
+                # the shared template records are not modified
+                fits.write(data, header=self.header[extname].records(), extname=extname)
+            return fits.read_raw()
+
+    def render_header(self):
         """
-        Writes single header file using the strict FITS format (i.e. empty
+        Render the header as bytes using the strict FITS format (i.e. empty
         HDUs, write_mode='fits') or YAML (write_mode='yaml')
         """
-        t0 = time.time()
         if self.write_mode == 'fits':
-            self.write_header_fits(filename)
+            return self.render_header_fits()
         elif self.write_mode == 'yaml':
-            self.write_header_yaml(filename)
-        else:
-            msg = "ERROR: header write_mode: {} not recognized".format(self.write_mode)
-            self.log.error(msg)
-            raise ValueError(msg)
-            return
+            return self.render_header_yaml()
+        msg = "ERROR: header write_mode: {} not recognized".format(self.write_mode)
+        self.log.error(msg)
+        raise ValueError(msg)
 
+    def write_header(self, filename):
+        """
+        Writes single header file using the strict FITS format (i.e. empty
+        HDUs, write_mode='fits') or YAML (write_mode='yaml'). The header is
+        rendered once, and the bytes are returned with their md5 checksum
+        so they can be uploaded without reading the file back.
+        """
+        t0 = time.time()
+        data = self.render_header()
+        with open(filename, 'wb') as outfile:
+            outfile.write(data)
+        md5value = hashlib.md5(data).hexdigest()
         self.log.info(f"Header write time: {elapsed_time(t0)}")
-        return
+        return data, md5value
 
     def set_mimeType(self):
         """